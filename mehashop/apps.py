@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class MehashopConfig(AppConfig):
+    name = 'mehashop'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -12,5 +12,12 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mehashop.settings')
+os.environ.setdefault('ASYNC_CATALOG_VIEWS', 'True')
+# Постоянные соединения под ASGI не переиспользуются, см. DATABASES в settings.py
+os.environ.setdefault('DATABASE_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
+
+from mehashop.suggest import warm_suggest_index  # noqa: E402
+
+warm_suggest_index()
@@ -0,0 +1,145 @@
+"""Асинхронные версии представлений каталога для запуска под ASGI.
+
+DRF 3.15 не поддерживает async-обработчики в APIView, поэтому здесь обычные
+View Django: тот же разбор параметров и те же ответы, что у представлений из
+views.py, но база читается через асинхронный ORM, а кэш - через aget/aset,
+и запрос не занимает поток на всё время обработки.
+Подключаются в urls.py при settings.ASYNC_CATALOG_VIEWS (по умолчанию в asgi.py).
+"""
+import json
+
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404
+from django.utils.cache import get_conditional_response
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+
+from .cache import aget_category_list, aget_category_tree
+from .models import Product
+from .pagination import InvalidCursor, apaginate_keyset, keyset_ordering, parse_page_size
+from .renderers import dumps
+from .serializers import ProductSerializer, product_only_fields, product_rows, serialize_product_rows
+from .views import (
+    PRODUCT_SORT_FIELDS, STREAM_CHUNK_SIZE, _apply_product_filters, _category_path_query, _product_cache_headers,
+    _product_etag, _product_fields
+)
+
+
+def _json_response(data, status=status.HTTP_200_OK):
+    return HttpResponse(dumps(data), status=status, content_type='application/json')
+
+
+def _error_response(message):
+    return _json_response({"error": message}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _unknown_fields_response(exc):
+    return _json_response({"error": "Неизвестные поля", "fields": exc.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+
+async def _afilter_products(data):
+    path_query = _category_path_query(data)
+    return _apply_product_filters(data, await path_query.afirst() if path_query is not None else None)
+
+
+async def _astream_products(products, fields):
+    rows = product_rows(products, fields).aiterator(chunk_size=STREAM_CHUNK_SIZE)
+    async for row in rows:
+        yield dumps(serialize_product_rows([row], fields=fields)[0]) + b'\n'
+
+
+class AsyncAPIView(View):
+    """Основа асинхронных представлений: как APIView, не требует CSRF-токена."""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+
+# POST /products - то же, что views.ProductListView; тело запроса - JSON
+class ProductListView(AsyncAPIView):
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return _error_response("Неправильный JSON")
+        if not isinstance(data, dict):
+            return _error_response("Неправильный JSON")
+
+        sort_by = data.get('sort_by', 'price')
+        if sort_by not in PRODUCT_SORT_FIELDS:
+            return _error_response("Неправильный параметр сортировки")
+        try:
+            fields = _product_fields(data)
+        except ValueError as exc:
+            return _unknown_fields_response(exc)
+
+        products = await _afilter_products(data)
+        attributes = data.get('attributes')
+        if attributes:
+            try:
+                products = products.filter_attributes(attributes)
+            except ValueError:
+                return _error_response("Неправильный фильтр по атрибутам")
+
+        if data.get('stream'):
+            products = products.order_by(*keyset_ordering(sort_by))
+            return StreamingHttpResponse(_astream_products(products, fields), content_type='application/x-ndjson')
+
+        cursor = data.get('cursor')
+        if cursor or data.get('page_size'):
+            try:
+                page_size = parse_page_size(data.get('page_size'))
+            except (TypeError, ValueError):
+                return _error_response("Неправильный размер страницы")
+            try:
+                rows = product_rows(products, fields, extra=[sort_by.lstrip('-')])
+                page, next_cursor = await apaginate_keyset(rows, sort_by, cursor, page_size)
+            except InvalidCursor:
+                return _error_response("Неправильный курсор")
+            return _json_response({"results": serialize_product_rows(page, fields=fields), "next_cursor": next_cursor})
+
+        rows = [row async for row in product_rows(products.order_by(sort_by), fields)]
+        return _json_response(serialize_product_rows(rows, fields=fields))
+
+
+# GET /product - то же, что views.ProductDetailView (ETag, Last-Modified, 304)
+class ProductDetailView(AsyncAPIView):
+    async def get(self, request, product_id):
+        try:
+            fields = _product_fields(request.GET)
+        except ValueError as exc:
+            return _unknown_fields_response(exc)
+        try:
+            product = await aget_object_or_404(Product.objects.only('updated_at', *product_only_fields(fields)),
+                                               id=product_id)
+        except Http404 as exc:
+            # Тот же ответ, что даёт обработчик исключений DRF
+            return _json_response({"detail": str(exc)}, status=status.HTTP_404_NOT_FOUND)
+
+        # Ответ всегда JSON, поэтому и ETag совпадает с JSON-ответом синхронного представления
+        etag = _product_etag(product, fields, 'json')
+        last_modified = int(product.updated_at.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = _json_response(ProductSerializer(product, fields=fields).data)
+        return _product_cache_headers(response, etag, last_modified)
+
+
+# GET /categories - то же, что views.CategoryListView
+class CategoryListView(AsyncAPIView):
+    async def get(self, request):
+        if request.GET.get('tree'):
+            data, etag = await aget_category_tree()
+        else:
+            data, etag = await aget_category_list()
+
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified['ETag'] = etag
+            return not_modified
+
+        response = _json_response(data)
+        response['ETag'] = etag
+        return response
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from .cache import auth_token_cache_key
+from .routers import use_primary
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication, который держит пользователя токена в кэше AUTH_TOKEN_CACHE_TIMEOUT секунд.
+
+    При попадании - один GET в Redis вместо запроса Token + User. Запись сбрасывается
+    сигналами при удалении токена (выход) и при сохранении пользователя (смена пароля,
+    блокировка, права). Пароль пользователя в кэш не кладётся.
+    """
+
+    def authenticate_credentials(self, key):
+        cache_key = auth_token_cache_key(key)
+        entry = cache.get(cache_key)
+        if entry is None:
+            model = self.get_model()
+            try:
+                # Из основной базы: удалённый токен или старый пользователь с отстающей реплики
+                # пролежали бы в кэше AUTH_TOKEN_CACHE_TIMEOUT секунд после сброса
+                with use_primary():
+                    token = model.objects.select_related('user').defer('user__password').get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            entry = {'user': token.user, 'created': token.created}
+            cache.set(cache_key, entry, settings.AUTH_TOKEN_CACHE_TIMEOUT)
+
+        user = entry['user']
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return user, self.get_model()(key=key, user=user, created=entry['created'])
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Category, Product
+from .routers import use_primary
+from .serializers import CategorySerializer, product_rows, serialize_product_rows
+
+
+# Версия формата данных в кэше - увеличить при изменении сериализаторов
+CACHE_SCHEMA_VERSION = 2
+
+CATEGORY_LIST_KEY = f'categories:v{CACHE_SCHEMA_VERSION}:list'
+CATEGORY_TREE_KEY = f'categories:v{CACHE_SCHEMA_VERSION}:tree'
+# Номер поколения фасетов: при изменении товаров ключ удаляется,
+# и все ранее посчитанные фасеты перестают читаться
+PRODUCT_FACETS_VERSION_KEY = f'product-facets:v{CACHE_SCHEMA_VERSION}:version'
+
+
+def _make_entry(data):
+    body = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, sort_keys=True)
+    return {'data': data, 'etag': '"%s"' % hashlib.md5(body.encode()).hexdigest()}
+
+
+def build_category_tree(categories):
+    """Строит вложенное дерево из плоского списка категорий за один проход."""
+    nodes = {item['id']: dict(item, children=[]) for item in categories}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node['parent'])
+        if parent is None:
+            roots.append(node)
+        else:
+            parent['children'].append(node)
+    return roots
+
+
+def _load_category_list():
+    # Кэш живёт сутки, поэтому читается основная база, а не, возможно, отстающая реплика
+    with use_primary():
+        categories = list(Category.objects.order_by('id'))
+    return [dict(item) for item in CategorySerializer(categories, many=True).data]
+
+
+def get_category_list():
+    """Возвращает (список категорий, ETag). При попадании в кэш - один GET в Redis."""
+    entry = cache.get(CATEGORY_LIST_KEY)
+    if entry is None:
+        entry = _make_entry(_load_category_list())
+        cache.set(CATEGORY_LIST_KEY, entry, settings.CATEGORY_CACHE_TIMEOUT)
+    return entry['data'], entry['etag']
+
+
+def get_category_tree():
+    """Возвращает (дерево категорий, ETag)."""
+    entry = cache.get(CATEGORY_TREE_KEY)
+    if entry is None:
+        categories, _ = get_category_list()
+        entry = _make_entry(build_category_tree(categories))
+        cache.set(CATEGORY_TREE_KEY, entry, settings.CATEGORY_CACHE_TIMEOUT)
+    return entry['data'], entry['etag']
+
+
+async def _aload_category_list():
+    with use_primary():
+        categories = [category async for category in Category.objects.order_by('id')]
+    return [dict(item) for item in CategorySerializer(categories, many=True).data]
+
+
+async def aget_category_list():
+    """get_category_list() для асинхронных представлений."""
+    entry = await cache.aget(CATEGORY_LIST_KEY)
+    if entry is None:
+        entry = _make_entry(await _aload_category_list())
+        await cache.aset(CATEGORY_LIST_KEY, entry, settings.CATEGORY_CACHE_TIMEOUT)
+    return entry['data'], entry['etag']
+
+
+async def aget_category_tree():
+    """get_category_tree() для асинхронных представлений."""
+    entry = await cache.aget(CATEGORY_TREE_KEY)
+    if entry is None:
+        categories, _ = await aget_category_list()
+        entry = _make_entry(build_category_tree(categories))
+        await cache.aset(CATEGORY_TREE_KEY, entry, settings.CATEGORY_CACHE_TIMEOUT)
+    return entry['data'], entry['etag']
+
+
+def invalidate_categories():
+    cache.delete_many([CATEGORY_LIST_KEY, CATEGORY_TREE_KEY])
+
+
+def get_product_facets(products, signature):
+    """Фасеты атрибутов для выборки products; signature - параметры фильтра, по которым она построена."""
+    version = cache.get_or_set(PRODUCT_FACETS_VERSION_KEY, time.time_ns, None)
+    digest = hashlib.md5(json.dumps(signature, cls=JSONEncoder, sort_keys=True).encode()).hexdigest()
+    key = f'product-facets:v{CACHE_SCHEMA_VERSION}:{version}:{digest}'
+    facets = cache.get(key)
+    if facets is None:
+        with use_primary():
+            facets = products.attribute_facets()
+        cache.set(key, facets, settings.PRODUCT_FACETS_TIMEOUT)
+    return facets
+
+
+def invalidate_product_facets():
+    cache.delete(PRODUCT_FACETS_VERSION_KEY)
+
+
+def _product_key(product_id):
+    return f'products:v{CACHE_SCHEMA_VERSION}:{product_id}'
+
+
+def get_product(product_id):
+    """Данные товара как у ProductSerializer (без request) - один GET в Redis при попадании."""
+    data = cache.get(_product_key(product_id))
+    if data is None:
+        data = get_products([product_id]).get(product_id)
+    return data
+
+
+def get_products(product_ids):
+    """{id: данные товара} одним get_many; промахи загружаются одним запросом и кладутся в кэш.
+
+    Удалённых товаров в результате нет.
+    """
+    keys = {_product_key(product_id): product_id for product_id in product_ids}
+    products = {keys[key]: data for key, data in cache.get_many(keys).items()}
+    missing = [product_id for product_id in keys.values() if product_id not in products]
+    if missing:
+        with use_primary():
+            rows = list(product_rows(Product.objects.filter(pk__in=missing)))
+        loaded = {row['id']: row for row in serialize_product_rows(rows)}
+        cache.set_many({_product_key(product_id): data for product_id, data in loaded.items()},
+                       settings.PRODUCT_CACHE_TIMEOUT)
+        products.update(loaded)
+    return products
+
+
+def invalidate_products(product_ids):
+    cache.delete_many([_product_key(product_id) for product_id in product_ids])
+
+
+def auth_token_cache_key(token_key):
+    # В ключе - хэш токена: сами токены в кэш не попадают
+    return f'auth-tokens:v{CACHE_SCHEMA_VERSION}:' + hashlib.sha256(token_key.encode()).hexdigest()
+
+
+def invalidate_auth_tokens(token_keys):
+    cache.delete_many([auth_token_cache_key(key) for key in token_keys])
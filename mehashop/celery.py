@@ -0,0 +1,10 @@
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mehashop.settings')
+
+app = Celery('mehashop')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+# Задачи проекта лежат в mehashop/task.py
+app.autodiscover_tasks(related_name='task')
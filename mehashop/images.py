@@ -0,0 +1,96 @@
+import io
+import posixpath
+
+from PIL import Image, ImageOps
+
+
+# Формат миниатюры -> (формат Pillow, расширение файла)
+FORMATS = {
+    'webp': ('WEBP', '.webp'),
+    'jpeg': ('JPEG', '.jpg'),
+}
+
+
+def thumbnail_name(name, width, image_format):
+    """Имя миниатюры: products/shuba.jpg -> products/thumbnails/shuba.jpg/320w.webp.
+
+    В пути - полное имя оригинала, так что у shuba.jpg и shuba.png миниатюры не совпадают.
+    """
+    directory, filename = posixpath.split(name)
+    return posixpath.join(directory, 'thumbnails', filename, f'{width}w{FORMATS[image_format][1]}')
+
+
+def thumbnail_widths(original_width, widths):
+    """Ширины миниатюр без увеличения: больше оригинала нет смысла, вместо них - сама ширина оригинала."""
+    result = sorted({width for width in widths if width < original_width})
+    if any(width >= original_width for width in widths):
+        result.append(original_width)
+    return result
+
+
+def render_thumbnails(data, widths, formats, quality):
+    """Миниатюры изображения (байты) - {формат: {ширина: байты}}.
+
+    Только Pillow, без Django: выполняется и в процессах generate_thumbnails.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG декодируется сразу в уменьшенном масштабе, если самая большая миниатюра это позволяет.
+        # Квадрат - потому что после поворота по EXIF ширина может стать высотой
+        image.draft('RGB', (max(widths), max(widths)))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    result = {image_format: {} for image_format in formats}
+    for width in thumbnail_widths(image.width, widths):
+        height = max(1, round(image.height * width / image.width))
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        for image_format in formats:
+            frame = resized
+            if image_format == 'jpeg' and has_alpha:
+                # В JPEG нет прозрачности - фон белый
+                frame = Image.new('RGB', resized.size, 'white')
+                frame.paste(resized, mask=resized.getchannel('A'))
+            output = io.BytesIO()
+            frame.save(output, FORMATS[image_format][0], quality=quality, optimize=True)
+            result[image_format][width] = output.getvalue()
+    return result
+
+
+def store_thumbnails(storage, name, rendered):
+    """Сохраняет миниатюры оригинала name, заменяя прежние миниатюры того же оригинала.
+
+    Возвращает Product.image_variants: {"source": оригинал, формат: {ширина: имя файла}}.
+    """
+    variants = {'source': name}
+    for image_format, sizes in rendered.items():
+        for width, content in sizes.items():
+            target = thumbnail_name(name, width, image_format)
+            if storage.exists(target):
+                storage.delete(target)
+            variants.setdefault(image_format, {})[str(width)] = storage.save(target, io.BytesIO(content))
+    return variants
+
+
+def delete_thumbnails(storage, variants):
+    """Удаляет файлы миниатюр из Product.image_variants."""
+    for image_format in FORMATS:
+        for name in variants.get(image_format, {}).values():
+            storage.delete(name)
+
+
+def image_srcset(variants, storage, build_url=None):
+    """{формат: значение srcset} из Product.image_variants, например {"webp": "a_320w.webp 320w, ..."}."""
+    srcset = {}
+    for image_format in FORMATS:
+        sizes = variants.get(image_format)
+        if not sizes:
+            continue
+        urls = []
+        for width, name in sorted(sizes.items(), key=lambda item: int(item[0])):
+            url = storage.url(name)
+            if build_url is not None:
+                url = build_url(url)
+            urls.append(f'{url} {width}w')
+        srcset[image_format] = ', '.join(urls)
+    return srcset
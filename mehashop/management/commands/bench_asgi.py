@@ -0,0 +1,223 @@
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from mehashop.models import Category, Product
+
+
+HOST = 'testserver'
+
+
+def _wsgi_request(app, method, path, body):
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': HOST,
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': HOST,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    statuses = []
+    result = app(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    try:
+        for _ in result:
+            pass
+    finally:
+        result.close()
+    return int(statuses[0].split()[0])
+
+
+async def _asgi_request(app, method, path, body):
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': b'',
+        'headers': [
+            (b'host', HOST.encode()),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+        'client': ('127.0.0.1', 0),
+        'server': (HOST, 80),
+    }
+    received = False
+    status_code = None
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # Клиент не отключается: Django сам отменит ожидание после ответа
+        await asyncio.Future()
+
+    async def send(message):
+        nonlocal status_code
+        if message['type'] == 'http.response.start':
+            status_code = message['status']
+
+    await app(scope, receive, send)
+    return status_code
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает запросы/с и p99 представлений каталога под WSGI с потоками и под ASGI "
+        "(mehashop.async_views) при одинаковом числе одновременных запросов"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', choices=['both', 'wsgi', 'asgi'], default='both',
+                            help="both - оба замера, каждый в отдельном процессе")
+        parser.add_argument('--rows', type=int, default=2000, help="Сколько товаров создать для замера")
+        parser.add_argument('--requests', type=int, default=3000, help="Запросов на сценарий")
+        parser.add_argument('--concurrency', type=int, default=64,
+                            help="Одновременных запросов: потоков для WSGI, задач для ASGI")
+        parser.add_argument('--category-id', type=int, help="Категория с уже созданными товарами (для --server wsgi/asgi)")
+
+    def handle(self, *args, **options):
+        if options['server'] != 'both':
+            if options['category_id'] is None:
+                raise CommandError("Для --server wsgi/asgi нужен --category-id")
+            return self._run(options['server'], options)
+
+        # Данные должны быть видны соединениям всех потоков и процессов, поэтому
+        # они сохраняются в базе и удаляются после замера
+        rng = random.Random(0)
+        category = Category.objects.create(name="bench_asgi")
+        try:
+            Product.objects.bulk_create(
+                (
+                    Product(name=f"Товар {i}", description="Описание", price=Decimal(rng.randint(1000, 300000)),
+                            category=category, attributes={"цвет": f"цвет {i % 10}"})
+                    for i in range(options['rows'])
+                ),
+                batch_size=5000,
+            )
+            connections.close_all()
+            for server in ['wsgi', 'asgi']:
+                # Отдельный процесс: urls.py выбирает представления по ASYNC_CATALOG_VIEWS при импорте
+                env = dict(os.environ, ASYNC_CATALOG_VIEWS='True' if server == 'asgi' else 'False')
+                if server == 'asgi':
+                    # Как в asgi.py: без постоянных соединений
+                    env.setdefault('DATABASE_CONN_MAX_AGE', '0')
+                command = [
+                    sys.executable, sys.argv[0], 'bench_asgi', '--server', server, '--category-id', str(category.id),
+                    '--requests', str(options['requests']), '--concurrency', str(options['concurrency']),
+                ]
+                subprocess.run(command, env=env, check=True)
+        finally:
+            Product.objects.filter(category=category).delete()
+            category.delete()
+
+    def _run(self, server, options):
+        if settings.ASYNC_CATALOG_VIEWS != (server == 'asgi'):
+            raise CommandError(f"Для --server {server} нужен ASYNC_CATALOG_VIEWS={server == 'asgi'}")
+        product_ids = list(
+            Product.objects.filter(category_id=options['category_id']).values_list('id', flat=True)
+        )
+        if not product_ids:
+            raise CommandError("В категории нет товаров")
+        rng = random.Random(0)
+        list_body = json.dumps({"category_id": options['category_id'], "page_size": 20}).encode()
+        scenarios = [
+            ("категории", lambda: ('GET', reverse('category-list'), b'')),
+            ("карточка товара", lambda: ('GET', reverse('product-detail', args=[rng.choice(product_ids)]), b'')),
+            ("страница товаров", lambda: ('POST', reverse('product-list'), list_body)),
+        ]
+        connections.close_all()
+
+        with override_settings(ALLOWED_HOSTS=[HOST]):
+            for title, make_request in scenarios:
+                requests = deque(make_request() for _ in range(options['requests']))
+                if server == 'wsgi':
+                    elapsed, timings, errors = self._measure_wsgi(requests, options['concurrency'])
+                else:
+                    elapsed, timings, errors = asyncio.run(self._measure_asgi(requests, options['concurrency']))
+                timings.sort()
+                p99 = timings[int(len(timings) * 0.99) - 1]
+                self.stdout.write(
+                    f"{server.upper()} {title}: {len(timings) / elapsed:.0f} запросов/с, "
+                    f"медиана {statistics.median(timings) * 1000:.1f} мс, p99 {p99 * 1000:.1f} мс"
+                    + (f", ошибок {errors}" if errors else "")
+                )
+
+    def _measure_wsgi(self, requests, concurrency):
+        app = WSGIHandler()
+        timings = []
+        errors = 0
+        lock = threading.Lock()
+
+        def worker():
+            nonlocal errors
+            while True:
+                try:
+                    method, path, body = requests.popleft()
+                except IndexError:
+                    break
+                start = time.perf_counter()
+                status = _wsgi_request(app, method, path, body)
+                duration = time.perf_counter() - start
+                with lock:
+                    timings.append(duration)
+                    errors += status >= 400
+            connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for future in [pool.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        return time.perf_counter() - start, timings, errors
+
+    async def _measure_asgi(self, requests, concurrency):
+        app = ASGIHandler()
+        timings = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            while requests:
+                method, path, body = requests.popleft()
+                start = time.perf_counter()
+                status = await _asgi_request(app, method, path, body)
+                timings.append(time.perf_counter() - start)
+                errors += status >= 400
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start, timings, errors
@@ -0,0 +1,73 @@
+import random
+import statistics
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from mehashop.models import Product
+from mehashop.serializers import product_rows, serialize_product_rows
+
+
+FURS = ["норковая", "лисья", "соболья", "песцовая", "каракулевая", "кроличья", "енотовая", "бобровая"]
+KINDS = ["шуба", "шапка", "жилет", "полушубок", "парка", "манто", "палантин", "варежки"]
+WORDS = ["тёплый", "лёгкий", "классический", "зимний", "длинный", "короткий", "капюшон", "пояс", "воротник"]
+
+
+class Command(BaseCommand):
+    help = "Замеряет время поиска товаров (ProductQuerySet.search) на каталоге заданного размера"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help="Сколько товаров создать для замера")
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--candidates', type=int, default=settings.PRODUCT_SEARCH_CANDIDATES,
+                            help="Сколько совпадений ранжировать (0 - все)")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        # Тестовые товары создаются в транзакции, которая в конце откатывается
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                (
+                    Product(
+                        name=f"{rng.choice(FURS).capitalize()} {rng.choice(KINDS)} арт. {i}",
+                        description=" ".join(rng.choices(WORDS, k=8)),
+                        price=Decimal(rng.randint(1000, 300000)),
+                    )
+                    for i in range(options['rows'])
+                ),
+                batch_size=5000,
+            )
+            with connection.cursor() as cursor:
+                # Новые строки лежат в списке ожидания GIN-индекса, пока его не разберёт autovacuum
+                cursor.execute("SELECT gin_clean_pending_list('product_search_gin'::regclass)")
+                cursor.execute('ANALYZE mehashop_product')
+
+            cases = [
+                ("редкое слово", {'text': str(options['rows'] // 2)}),
+                ("частое слово", {'text': "шуба"}),
+                ("два слова", {'text': "соболья шапка"}),
+                ("префикс", {'text': "соболья пал", 'prefix': True}),
+            ]
+            for title, params in cases:
+                self._measure(title, Product.objects.all(), params, options)
+            self._measure("частое слово + цена", Product.objects.filter(price__lte=5000), {'text': "шуба"}, options)
+            transaction.set_rollback(True)
+
+    def _measure(self, title, products, params, options):
+        def run():
+            rows = product_rows(products.search(**params, candidates=options['candidates']))[:options['page_size']]
+            return serialize_product_rows(rows)
+
+        run()
+        timings = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(f"{title}: медиана {statistics.median(timings) * 1000:.2f} мс, p95 {p95 * 1000:.2f} мс")
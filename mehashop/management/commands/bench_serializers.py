@@ -0,0 +1,52 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from mehashop.models import Product
+from mehashop.renderers import FastJSONRenderer
+from mehashop.serializers import ProductSerializer, product_rows, serialize_product_rows
+
+
+class Command(BaseCommand):
+    help = "Сравнивает ProductSerializer + JSONRenderer с быстрым путём serialize_product_rows + FastJSONRenderer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help="Сколько товаров создать для замера")
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        # Тестовые товары создаются в транзакции, которая в конце откатывается
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                Product(
+                    name=f"Товар {i}",
+                    description="Описание товара " * 10,
+                    image=f"products/{i}.jpg",
+                    price=Decimal(i % 10000) + Decimal('0.99'),
+                    attributes={"color": "black", "size": i % 50, "tags": ["мех", "зима"]},
+                )
+                for i in range(options['rows'])
+            )
+            products = Product.objects.order_by('id')
+
+            def generic():
+                return JSONRenderer().render(ProductSerializer(products, many=True).data)
+
+            def fast():
+                return FastJSONRenderer().render(serialize_product_rows(product_rows(products)))
+
+            self._measure("ProductSerializer + JSONRenderer", generic, options)
+            self._measure("serialize_product_rows + FastJSONRenderer", fast, options)
+            transaction.set_rollback(True)
+
+    def _measure(self, title, func, options):
+        timings = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        self.stdout.write(f"{title}: {best * 1000:.1f} мс, {options['rows'] / best:.0f} строк/с")
@@ -0,0 +1,58 @@
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from mehashop.management.commands.bench_search import FURS, KINDS, WORDS
+from mehashop.suggest import SuggestIndex, normalize
+
+
+class Command(BaseCommand):
+    help = "Замеряет построение, память и время поиска индекса подсказок (mehashop.suggest)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000, help="Сколько названий в индексе")
+        parser.add_argument('--lookups', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        names = [
+            f"{rng.choice(FURS).capitalize()} {rng.choice(KINDS)} {rng.choice(WORDS)} {i}"
+            for i in range(options['rows'])
+        ]
+
+        start = time.perf_counter()
+        index = SuggestIndex(enumerate(names, 1))
+        build = time.perf_counter() - start
+        # Память отдельным построением: под tracemalloc оно идёт в разы медленнее
+        del index
+        tracemalloc.start()
+        index = SuggestIndex(enumerate(names, 1))
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        self.stdout.write(
+            f"Построение: {build * 1000:.0f} мс на {len(index)} названий, "
+            f"{len(index.keys)} ключей, {memory / 2 ** 20:.1f} МБ"
+        )
+
+        prefixes = []
+        for _ in range(options['lookups']):
+            word = rng.choice(normalize(rng.choice(names)).split(' '))
+            prefixes.append(word[:rng.randint(1, len(word))])
+        timings = []
+        for prefix in prefixes:
+            start = time.perf_counter()
+            index.lookup(prefix)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        self.stdout.write(
+            f"Поиск: медиана {statistics.median(timings) * 1e6:.1f} мкс, p99 {p99 * 1e6:.1f} мкс"
+        )
+
+        start = time.perf_counter()
+        for product_id in range(1, 1001):
+            index.add(product_id, names[product_id - 1] + " new")
+        self.stdout.write(f"Изменение названия: {(time.perf_counter() - start) * 1000:.0f} мкс на товар")
@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mehashop.images import render_thumbnails
+from mehashop.models import Product
+from mehashop.routers import use_primary
+from mehashop.task import save_product_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Создаёт миниатюры изображений товаров, у которых их нет или они устарели (параллельно в процессах)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Число процессов")
+        parser.add_argument('--all', action='store_true', help="Пересоздать миниатюры всех товаров")
+
+    def handle(self, *args, **options):
+        with use_primary():
+            rows = list(Product.objects.exclude(image='').order_by('id').values_list('id', 'image', 'image_variants'))
+        pending = [
+            (product_id, image) for product_id, image, variants in rows
+            if options['all'] or variants.get('source') != image
+        ]
+        self.stdout.write(f"Товаров без актуальных миниатюр: {len(pending)}")
+
+        config = settings.PRODUCT_THUMBNAILS
+        storage = Product._meta.get_field('image').storage
+        self.done = self.failed = 0
+        start = time.perf_counter()
+        # Файлы читает и пишет этот процесс, в пуле - только сжатие (render_thumbnails не нужен Django).
+        # spawn: дочерним процессам не достаются соединения с базой
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(options['workers'], mp_context=context) as pool:
+            # Изображений в памяти не больше, чем задач в работе
+            in_flight = deque()
+            for product_id, name in pending:
+                try:
+                    with storage.open(name, 'rb') as image:
+                        data = image.read()
+                except OSError as exc:
+                    self._failed(product_id, name, exc)
+                    continue
+                future = pool.submit(render_thumbnails, data, config['WIDTHS'], config['FORMATS'], config['QUALITY'])
+                in_flight.append((product_id, name, future))
+                if len(in_flight) >= options['workers'] * 2:
+                    self._save(*in_flight.popleft())
+            while in_flight:
+                self._save(*in_flight.popleft())
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово: {self.done}, ошибок: {self.failed} за {elapsed:.1f} с "
+            f"({len(pending) / max(elapsed, 1e-9):.1f} товаров/с)"
+        ))
+
+    def _save(self, product_id, name, future):
+        try:
+            rendered = future.result()
+        except Exception as exc:
+            self._failed(product_id, name, exc)
+            return
+        self.done += save_product_thumbnails(product_id, name, rendered)
+
+    def _failed(self, product_id, name, exc):
+        self.failed += 1
+        self.stderr.write(f"Товар {product_id} ({name}): {type(exc).__name__}: {exc}")
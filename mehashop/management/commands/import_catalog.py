@@ -0,0 +1,313 @@
+import csv
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from mehashop.cache import invalidate_categories, invalidate_product_facets, invalidate_products
+from mehashop.models import Cart, Category, Product
+from mehashop.routers import use_primary
+from mehashop.suggest import catalog_changed
+from mehashop.task import delete_product_thumbnails
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+
+FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+# Колонки, которые перезаписываются у уже существующих строк.
+# Родитель категории меняется только в _finish_categories, после проверки на циклы
+CATEGORY_UPDATE_FIELDS = ['name']
+PRODUCT_UPDATE_FIELDS = ['name', 'description', 'price', 'category', 'image', 'image_variants', 'attributes', 'updated_at']
+
+
+def _read_csv(stream):
+    reader = csv.DictReader(stream)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def _read_ndjson(stream):
+    # Строки разбираются в _record: ошибка в одной строке не останавливает загрузку
+    for line, text in enumerate(stream, 1):
+        if text.strip():
+            yield line, text
+
+
+def _cycle_nodes(parents):
+    """Категории, лежащие на циклах в {id: id родителя}."""
+    on_cycle, visited = set(), set()
+    for start in parents:
+        chain = {}
+        node = start
+        while node is not None and node not in visited:
+            visited.add(node)
+            chain[node] = len(chain)
+            node = parents.get(node)
+        if node in chain:
+            on_cycle.update(list(chain)[chain[node]:])
+    return on_cycle
+
+
+def _record(raw):
+    record = _json_loads(raw) if isinstance(raw, str) else raw
+    if not isinstance(record, dict):
+        raise ValueError("ожидается объект")
+    return record
+
+
+def _id(value):
+    if value in (None, ''):
+        return None
+    value = int(value)
+    if value <= 0:
+        raise ValueError(f"неверный id: {value}")
+    return value
+
+
+def _required_id(record):
+    value = _id(record.get('id'))
+    if value is None:
+        raise ValueError("не указан id")
+    return value
+
+
+def _attributes(value):
+    if value in (None, ''):
+        return {}
+    if isinstance(value, str):
+        value = _json_loads(value)
+    if not isinstance(value, dict):
+        raise ValueError("attributes должен быть объектом")
+    return value
+
+
+def _category(raw):
+    record = _record(raw)
+    category = Category(id=_required_id(record), parent_id=_id(record.get('parent')))
+    category.name = Category._meta.get_field('name').clean(record.get('name'), category)
+    if category.parent_id == category.id:
+        raise ValueError("категория не может быть родителем самой себя")
+    return category
+
+
+def _product(raw):
+    record = _record(raw)
+    price = record.get('price')
+    if isinstance(price, float):
+        # Из NDJSON число приходит как float: 5999.99 -> "5999.99", а не 5999.98999...
+        price = str(price)
+    product = Product(
+        id=_required_id(record),
+        description=record.get('description') or '',
+        image=record.get('image') or '',
+        category_id=_id(record.get('category')),
+        attributes=_attributes(record.get('attributes')),
+    )
+    product.name = Product._meta.get_field('name').clean(record.get('name'), product)
+    product.price = Product._meta.get_field('price').clean(price, product)
+    if len(product.image.name) > Product._meta.get_field('image').max_length:
+        raise ValueError("слишком длинное имя изображения")
+    return product
+
+
+class Command(BaseCommand):
+    help = (
+        "Загружает категории и товары из CSV или NDJSON потоково, пачками bulk_create с обновлением "
+        "существующих строк по id (каждая пачка - в своей транзакции)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', help="Файл категорий: id, name, parent (\"-\" - stdin)")
+        parser.add_argument('--products', help=(
+            "Файл товаров: id, name, description, price, category, image, attributes (\"-\" - stdin)"
+        ))
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help="Формат файлов, по умолчанию - по расширению (.csv, .ndjson, .jsonl)")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Строк в пачке (и в транзакции)")
+
+    def handle(self, *args, **options):
+        if not options['categories'] and not options['products']:
+            raise CommandError("Укажите --categories и/или --products")
+        if options['categories'] == options['products'] == '-':
+            raise CommandError("Из stdin можно загрузить только один файл")
+        self.batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+
+        with use_primary():
+            # Категории загружаются первыми: на них ссылаются товары
+            # id категории -> id родителя в базе
+            self.category_parents = dict(Category.objects.values_list('id', 'parent_id'))
+            if options['categories']:
+                # id категории -> (файл, строка, id родителя из файла)
+                self.new_parents = {}
+                self._import(
+                    options['categories'], options['format'], Category, "Категории", _category, self._save_categories,
+                    finish=self._finish_categories,
+                )
+            if options['products']:
+                self.pending_thumbnails = 0
+                self._import(options['products'], options['format'], Product, "Товары", _product, self._save_products)
+                invalidate_product_facets()
+                catalog_changed()
+                if self.pending_thumbnails:
+                    self.stdout.write(
+                        f"Товаров с новыми изображениями: {self.pending_thumbnails}, "
+                        f"миниатюры создаст python manage.py generate_thumbnails"
+                    )
+
+    def _open(self, path, file_format):
+        file_format = file_format or FORMATS.get(os.path.splitext(path)[1].lower())
+        if file_format is None:
+            raise CommandError(f"Не удалось определить формат {path}, укажите --format")
+        if path == '-':
+            stream = sys.stdin
+        else:
+            try:
+                # utf-8-sig: CSV из Excel начинается с BOM
+                stream = open(path, newline='', encoding='utf-8-sig')
+            except OSError as exc:
+                raise CommandError(exc)
+        return stream, _read_csv if file_format == 'csv' else _read_ndjson
+
+    def _import(self, path, file_format, model, title, convert, save, finish=None):
+        stream, read = self._open(path, file_format)
+        self.done = self.created = self.failed = 0
+        start = time.perf_counter()
+        try:
+            rows = read(stream)
+            while chunk := list(islice(rows, self.batch_size)):
+                objects = {}
+                for line, raw in chunk:
+                    try:
+                        obj = convert(raw)
+                    except (KeyError, TypeError, ValueError, ValidationError) as exc:
+                        self._failed(path, line, exc)
+                        continue
+                    # Повтор id в одной пачке: INSERT ... ON CONFLICT не может изменить строку дважды
+                    objects.pop(obj.id, None)
+                    objects[obj.id] = (line, obj)
+                save(path, objects)
+                if self.verbosity >= 2:
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f"{title}: {self.done} строк, {self.done / max(elapsed, 1e-9):.0f} строк/с")
+        except csv.Error as exc:
+            raise CommandError(f"{path}: {exc}")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if finish is not None:
+            finish()
+
+        # Строки загружены с явными id - последовательности должны продолжить после них, как после loaddata
+        connection = connections[DEFAULT_DB_ALIAS]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"{title}: загружено {self.done} (новых {self.created}), ошибок {self.failed} за {elapsed:.1f} с "
+            f"({self.done / max(elapsed, 1e-9):.0f} строк/с)"
+        ))
+
+    def _failed(self, path, line, exc):
+        self.failed += 1
+        message = '; '.join(exc.messages) if isinstance(exc, ValidationError) else str(exc)
+        self.stderr.write(f"{path}:{line}: {type(exc).__name__}: {message}")
+
+    def _save_categories(self, path, objects):
+        if not objects:
+            return
+        categories = []
+        for line, category in objects.values():
+            # Родитель может идти в файле позже или замыкать цикл - ссылки проставятся в _finish_categories,
+            # одной транзакцией. До тех пор у существующих категорий остаётся прежний родитель,
+            # новые - корневые
+            self.new_parents[category.id] = (path, line, category.parent_id)
+            category.parent_id = None
+            categories.append(category)
+        with transaction.atomic():
+            Category.objects.bulk_create(
+                categories, update_conflicts=True, unique_fields=['id'], update_fields=CATEGORY_UPDATE_FIELDS,
+            )
+        for category_id in objects.keys() - self.category_parents.keys():
+            self.created += 1
+            self.category_parents[category_id] = None
+        self.done += len(objects)
+
+    def _finish_categories(self):
+        parents = {}
+        for category_id, (path, line, parent_id) in self.new_parents.items():
+            if parent_id is None or parent_id in self.category_parents:
+                parents[category_id] = parent_id
+            else:
+                self._failed(path, line, ValueError(f"нет родительской категории {parent_id}"))
+        # Строки, замыкающие цикл, пропускаются: такие категории остаются со старым родителем.
+        # Откат одной строки может замкнуть другой цикл, поэтому - до неподвижной точки
+        while cycle := _cycle_nodes({**self.category_parents, **parents}) & parents.keys():
+            for category_id in sorted(cycle, key=lambda category_id: self.new_parents[category_id][1]):
+                path, line, parent_id = self.new_parents[category_id]
+                self._failed(path, line, ValueError(f"цикл в дереве категорий через {parent_id}"))
+                del parents[category_id]
+        resolved = [
+            Category(id=category_id, parent_id=parent_id) for category_id, parent_id in parents.items()
+            if parent_id != self.category_parents[category_id]
+        ]
+        try:
+            # Пути всего дерева - одним проходом, а не Category.save() на каждую строку
+            with transaction.atomic():
+                Category.objects.bulk_update(resolved, ['parent'], batch_size=self.batch_size)
+                Category.objects.rebuild_paths(batch_size=self.batch_size)
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.category_parents.update(parents)
+        invalidate_categories()
+
+    def _save_products(self, path, objects):
+        products = []
+        for line, product in objects.values():
+            if product.category_id is not None and product.category_id not in self.category_parents:
+                self._failed(path, line, ValueError(f"нет категории {product.category_id}"))
+                continue
+            products.append(product)
+        if not products:
+            return
+
+        ids = [product.id for product in products]
+        existing = dict(Product.objects.filter(pk__in=ids).values_list('id', 'image_variants'))
+        replaced = []
+        for product in products:
+            variants = existing.get(product.id, {})
+            # Миниатюры остаются, только если изображение не сменилось (как в сигнале product_saving)
+            if product.image and variants.get('source') == product.image.name:
+                product.image_variants = variants
+            else:
+                product.image_variants = {}
+                if variants:
+                    replaced.append(variants)
+            self.pending_thumbnails += bool(product.image) and not product.image_variants
+
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                products, update_conflicts=True, unique_fields=['id'], update_fields=PRODUCT_UPDATE_FIELDS,
+            )
+            # Цены могли измениться - пересчитываем итоги корзин, где лежат обновлённые товары
+            if existing:
+                Cart.objects.filter(cartitem__product__in=list(existing)).refresh_totals()
+        # После коммита: запрос, прочитавший строку до коммита, мог положить её в кэш
+        invalidate_products(ids)
+        for variants in replaced:
+            delete_product_thumbnails.delay(variants)
+        self.created += len(products) - len(existing)
+        self.done += len(products)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mehashop.models import Category
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает материализованные пути (Category.path) для всего дерева категорий"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            changed = Category.objects.rebuild_paths(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Обновлено категорий: {changed}"))
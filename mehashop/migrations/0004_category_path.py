@@ -0,0 +1,31 @@
+# Generated by Django 5.1.6 on 2026-10-17 19:09
+
+import mehashop.models
+from django.db import migrations, models
+
+
+def build_paths(apps, schema_editor):
+    Category = apps.get_model('mehashop', 'Category')
+    Category.objects.rebuild_paths()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mehashop', '0003_order_payment_id_order_payment_method_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='category',
+            managers=[
+                ('objects', mehashop.models.CategoryManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
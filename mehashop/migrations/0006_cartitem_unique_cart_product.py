@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-17 19:14
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    # Повторяющиеся позиции одного товара в корзине сливаем в одну
+    CartItem = apps.get_model('mehashop', 'CartItem')
+    duplicates = (
+        CartItem.objects.values('cart', 'product')
+        .annotate(n=Count('id'), keep=Min('id'), total=Sum('quantity'))
+        .filter(n__gt=1)
+    )
+    for row in duplicates:
+        items = CartItem.objects.filter(cart=row['cart'], product=row['product'])
+        items.filter(id=row['keep']).update(quantity=row['total'])
+        items.exclude(id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mehashop', '0005_cart_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
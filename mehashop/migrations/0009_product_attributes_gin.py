@@ -0,0 +1,20 @@
+# Generated by Django 5.1.6 on 2026-10-17 19:35
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('mehashop', '0008_product_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='product',
+            index=GinIndex(fields=['attributes'], name='product_attributes_gin', opclasses=['jsonb_path_ops']),
+        ),
+    ]
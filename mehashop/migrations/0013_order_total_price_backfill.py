@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-17 21:40
+
+from django.db import migrations, models
+from django.db.models import Exists, F, OuterRef, Subquery, Sum
+
+
+def fill_order_totals(apps, schema_editor):
+    # Раньше сумма заказа считалась только при запуске оплаты (CreatePaymentView),
+    # у неоплаченных заказов она осталась нулевой
+    Order = apps.get_model('mehashop', 'Order')
+    OrderItem = apps.get_model('mehashop', 'OrderItem')
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    total = items.annotate(
+        total=Sum(F('quantity') * F('price'), output_field=models.DecimalField())
+    ).values('total')
+    Order.objects.filter(total_price=0).filter(Exists(items)).update(total_price=Subquery(total))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mehashop', '0012_product_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
@@ -1,26 +1,330 @@
-from django.db import models
+import json
+import re
+from decimal import Decimal
+
+from django.core.exceptions import EmptyResultSet
+from django.db import IntegrityError, connections, models, router, transaction
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField
+from django.db.models import F, Lookup, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Concat, Substr
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+class CategoryManager(models.Manager):
+    use_in_migrations = True
+
+    def rebuild_paths(self, batch_size=1000):
+        """Пересчитывает path всех категорий за один проход по таблице."""
+        rows = {pk: (parent_id, path) for pk, parent_id, path in self.values_list('id', 'parent_id', 'path')}
+        paths = {}
+        for pk in rows:
+            chain = []
+            node = pk
+            while node is not None and node not in paths:
+                if node in chain:
+                    raise ValueError(f"Цикл в дереве категорий: {chain}")
+                chain.append(node)
+                node = rows[node][0]
+            prefix = paths[node] if node is not None else ''
+            for node in reversed(chain):
+                prefix = f'{prefix}{node}/'
+                paths[node] = prefix
+
+        changed = [self.model(id=pk, path=path) for pk, path in paths.items() if rows[pk][1] != path]
+        self.bulk_update(changed, ['path'], batch_size=batch_size)
+        return len(changed)
+
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE)
+    # Материализованный путь из id предков и самой категории, например "1/5/12/".
+    # Поддерево категории - все записи, у которых path начинается с её path.
+    path = models.CharField(max_length=255, db_index=True, editable=False, default='')
+
+    objects = CategoryManager()
+
+    def save(self, *args, **kwargs):
+        # path берём из базы, в которую пишем: у объектов в памяти он мог устареть после
+        # переноса предка, а на отстающей реплике - ещё не обновиться
+        using = kwargs.get('using') or router.db_for_write(Category, instance=self)
+        stored = dict(
+            Category.objects.using(using).filter(pk__in=[self.pk, self.parent_id]).values_list('pk', 'path')
+        )
+        parent_path = stored.get(self.parent_id, '') if self.parent_id else ''
+        old_path = stored.get(self.pk, '') if self.pk else ''
+        if old_path and parent_path.startswith(old_path):
+            raise ValueError("Категорию нельзя вложить в саму себя или в её потомка")
+
+        if self.pk:
+            self.path = f'{parent_path}{self.pk}/'
+        super().save(*args, **kwargs)
+
+        if not old_path:
+            # id новой категории известен только после вставки
+            self.path = f'{parent_path}{self.pk}/'
+            Category.objects.using(using).filter(pk=self.pk).update(path=self.path)
+        elif old_path != self.path:
+            # Категорию перенесли - переписываем префикс у всех потомков одним запросом.
+            # При удалении ничего делать не нужно: потомки удаляются каскадом.
+            Category.objects.using(using).filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                path=Concat(Value(self.path), Substr('path', len(old_path) + 1))
+            )
+
+@models.JSONField.register_lookup
+class JSONPathExists(Lookup):
+    """field__jsonpath_exists='$.ключ ? (@ == 1)' - оператор @? PostgreSQL, работает по GIN-индексу."""
+    lookup_name = 'jsonpath_exists'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} @? {rhs}::jsonpath', (*lhs_params, *rhs_params)
+
+
+def _jsonpath_literal(value):
+    # Строки и числа в jsonpath записываются так же, как в JSON
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _is_attribute_value(value):
+    return isinstance(value, (str, int, float, bool))
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _attribute_condition(key, value):
+    """Условие jsonpath для одного атрибута из фильтра ProductQuerySet.filter_attributes()."""
+    if isinstance(value, dict):
+        if not value or set(value) - {'min', 'max'} or not all(_is_number(v) for v in value.values()):
+            raise ValueError(value)
+        checks = []
+        if 'min' in value:
+            checks.append(f'@ >= {_jsonpath_literal(value["min"])}')
+        if 'max' in value:
+            checks.append(f'@ <= {_jsonpath_literal(value["max"])}')
+        condition = ' && '.join(checks)
+    else:
+        values = value if isinstance(value, list) else [value]
+        if not values or not all(_is_attribute_value(item) for item in values):
+            raise ValueError(value)
+        condition = ' || '.join(f'@ == {_jsonpath_literal(item)}' for item in values)
+    return f'$.{_jsonpath_literal(key)} ? ({condition})'
+
+
+_SEARCH_WORD_RE = re.compile(r'\w+')
+
+
+def _prefix_search_query(text):
+    # Последнее слово ещё набирается - ищем его как начало слова: "норк шуб" -> "норк & шуб:*"
+    words = _SEARCH_WORD_RE.findall(text)
+    if not words:
+        return None
+    words[-1] += ':*'
+    return SearchQuery(' & '.join(words), search_type='raw', config='russian')
+
+
+class ProductQuerySet(models.QuerySet):
+    def search(self, text, prefix=False, candidates=None):
+        """Полнотекстовый поиск по названию и описанию, по убыванию релевантности.
+
+        text понимается как запрос websearch ("фразы в кавычках", -исключения, or),
+        с prefix=True - как набираемый текст для автодополнения.
+
+        Если задан candidates, отдельным запросом выбираются id первых candidates
+        совпадений из GIN-индекса, и ранжируются только они. Для слов, которые есть
+        в большой части каталога, порядок тогда приблизительный, зато время ответа
+        не растёт вместе с числом совпадений.
+        """
+        query = _prefix_search_query(text) if prefix else SearchQuery(text, search_type='websearch', config='russian')
+        if query is None:
+            return self.none()
+        matches = self.filter(search_vector=query)
+        if candidates:
+            ids = list(matches.order_by().values_list('pk', flat=True)[:candidates])
+            matches = self.model.objects.filter(pk__in=ids)
+        return matches.annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', 'id')
+
+    def filter_attributes(self, filters):
+        """Фильтр по Product.attributes, например
+        {"цвет": "чёрный", "размеры": [44, 46], "длина": {"min": 100, "max": 120}}.
+
+        Строка или число - равенство, список - любое из значений, min/max - диапазон
+        чисел. У атрибутов-списков достаточно совпадения одного элемента (нестрогий
+        режим jsonpath), значения другого типа (строка в числовом диапазоне) не подходят.
+        Равенство и списки ищутся по GIN-индексу. ValueError при неправильном формате.
+        """
+        if not isinstance(filters, dict) or not all(isinstance(key, str) for key in filters):
+            raise ValueError(filters)
+        queryset = self
+        for key, value in filters.items():
+            queryset = queryset.filter(attributes__jsonpath_exists=_attribute_condition(key, value))
+        return queryset
+
+    def set_image_variants(self, source, variants):
+        """Сохраняет миниатюры товаров, у которых изображение всё ещё source.
+
+        Одним UPDATE без сигналов; updated_at меняется, чтобы сменился ETag карточки.
+        """
+        return self.filter(image=source).update(image_variants=variants, updated_at=timezone.now())
+
+    def attribute_facets(self):
+        """Сколько товаров из выборки у каждого значения каждого атрибута - одним запросом.
+
+        Элементы атрибутов-списков считаются по отдельности. Возвращает
+        {атрибут: [{"value": значение, "count": число}, ...]} по убыванию count.
+        """
+        try:
+            # Компилируется для той же базы, где выполнится: sql_with_params() берёт соединение по умолчанию
+            sql, params = self.order_by().values('attributes').query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            # Заведомо пустая выборка (.none(), pk__in=[])
+            return {}
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(f"""
+                SELECT attr.key, COALESCE(item.value, attr.value)::text, COUNT(*)
+                FROM ({sql}) AS product
+                CROSS JOIN LATERAL jsonb_each(product.attributes) AS attr
+                LEFT JOIN LATERAL jsonb_array_elements(
+                    CASE WHEN jsonb_typeof(attr.value) = 'array' THEN attr.value END
+                ) AS item ON true
+                WHERE jsonb_typeof(product.attributes) = 'object'
+                GROUP BY attr.key, COALESCE(item.value, attr.value)
+                ORDER BY attr.key, 3 DESC, COALESCE(item.value, attr.value)
+            """, params)
+            rows = cursor.fetchall()
+        facets = {}
+        for key, value, count in rows:
+            facets.setdefault(key, []).append({'value': json.loads(value), 'count': count})
+        return facets
+
 
 class Product(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     image = models.ImageField(upload_to='products/')
+    # Миниатюры изображения (mehashop.images): {"source": image, "webp": {"320": имя файла, ...}, "jpeg": {...}}.
+    # Заполняются задачей generate_product_thumbnails, при смене изображения сбрасываются
+    image_variants = models.JSONField(default=dict, blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True)
     attributes = models.JSONField(default=dict)
+    # Время последнего изменения - для ETag / Last-Modified карточки товара
+    updated_at = models.DateTimeField(auto_now=True)
+    # Поисковый вектор считает сама база при каждой записи строки (в том числе при bulk_create/update)
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('name', weight='A', config='russian')
+            + SearchVector('description', weight='B', config='russian')
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = ProductQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Название при загрузке: подсказки (mehashop.suggest) обновляются, только если оно изменилось
+        instance._loaded_name = instance.__dict__.get('name')
+        return instance
+
+    class Meta:
+        # Под фильтры и сортировки ProductListView: категория + диапазон цен
+        # с сортировкой по цене/названию; id - второй ключ keyset-пагинации
+        indexes = [
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'name', 'id'], name='product_category_name_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_idx'),
+            # Фильтры по атрибутам (@?). jsonb_path_ops индексирует пары путь-значение,
+            # поэтому ключ, который есть у всех товаров, не раздувает поиск
+            GinIndex(fields=['attributes'], opclasses=['jsonb_path_ops'], name='product_attributes_gin'),
+            GinIndex(fields=['search_vector'], name='product_search_gin'),
+        ]
+
+class CartQuerySet(models.QuerySet):
+    def refresh_totals(self):
+        """Пересчитывает item_count и subtotal корзин одним UPDATE по их позициям.
+
+        Корзины сначала блокируются: в READ COMMITTED подзапрос UPDATE, дождавшийся чужой блокировки
+        строки, всё равно не видит позиций, добавленных той транзакцией, и затёр бы её итоги.
+        Запрос после SELECT ... FOR UPDATE получает новый снимок и их видит.
+        """
+        locked = self.select_for_update(of=('self',)).order_by('pk')
+        with transaction.atomic(using=locked.db, savepoint=False):
+            cart_ids = list(locked.values_list('pk', flat=True))
+            if not cart_ids:
+                return 0
+            items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+            item_count = items.annotate(total=Sum('quantity')).values('total')
+            subtotal = items.annotate(
+                total=Sum(F('quantity') * F('product__price'), output_field=models.DecimalField())
+            ).values('total')
+            return self.model._base_manager.using(locked.db).filter(pk__in=cart_ids).update(
+                item_count=Coalesce(Subquery(item_count), 0),
+                subtotal=Coalesce(Subquery(subtotal), Value(Decimal('0')), output_field=models.DecimalField()),
+            )
+
 
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Денормализованные итоги для бейджа корзины: число единиц товара и сумма.
+    # Обновляются через Cart.objects.filter(...).refresh_totals() при изменении позиций.
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = CartQuerySet.as_manager()
+
+class CartItemManager(models.Manager):
+    def add_quantity(self, cart, product, quantity):
+        """Добавляет quantity единиц товара в корзину, не теряя параллельные добавления.
+
+        На PostgreSQL это один запрос INSERT ... ON CONFLICT DO UPDATE.
+        """
+        db = router.db_for_write(self.model)
+        connection = connections[db]
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {table} (cart_id, product_id, quantity) VALUES (%s, %s, %s) "
+                    f"ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {table}.quantity + EXCLUDED.quantity "
+                    f"RETURNING id, quantity",
+                    [cart.pk, product.pk, quantity]
+                )
+                pk, quantity = cursor.fetchone()
+            return self.model(pk=pk, cart=cart, product=product, quantity=quantity)
+
+        # Остальные СУБД: атомарный UPDATE через F(), вставка если позиции ещё нет
+        items = self.using(db).filter(cart=cart, product=product)
+        if not items.update(quantity=F('quantity') + quantity):
+            try:
+                with transaction.atomic(using=db):
+                    return self.using(db).create(cart=cart, product=product, quantity=quantity)
+            except IntegrityError:
+                # Позицию успел создать параллельный запрос
+                items.update(quantity=F('quantity') + quantity)
+        return items.get()
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    objects = CartItemManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
 
 class Order(models.Model):
     STATUS_CHOICES = [
@@ -34,7 +338,7 @@ class Order(models.Model):
     status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     total_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
-    payment_id = models.CharField(max_length=100, blank=True, null=True)  # ID платежа в системе
+    payment_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)  # ID платежа в системе
     payment_status = models.CharField(max_length=50, blank=True, null=True)  # Статус платежа
     payment_method = models.CharField(max_length=50, blank=True, null=True)  # Например, "YooKassa"
 
@@ -48,4 +352,36 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
-    price = models.DecimalField(max_digits=10, decimal_places=2)
\ No newline at end of file
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+class PaymentEventManager(models.Manager):
+    def record(self, payment_id, event):
+        """Записывает событие в журнал. False, если оно уже было обработано."""
+        db = router.db_for_write(self.model)
+        connection = connections[db]
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {table} (payment_id, event, created_at) VALUES (%s, %s, %s) "
+                    f"ON CONFLICT (payment_id, event) DO NOTHING RETURNING id",
+                    [payment_id, event, timezone.now()]
+                )
+                return cursor.fetchone() is not None
+        _, created = self.using(db).get_or_create(payment_id=payment_id, event=event)
+        return created
+
+
+class PaymentEvent(models.Model):
+    # Журнал обработанных уведомлений ЮKassa: повторные доставки отсеиваются по (payment_id, event)
+    payment_id = models.CharField(max_length=100)
+    event = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = PaymentEventManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['payment_id', 'event'], name='unique_payment_event'),
+        ]
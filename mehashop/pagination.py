@@ -0,0 +1,103 @@
+import base64
+import binascii
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Q
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def keyset_ordering(sort_by):
+    """Сортировка с id в качестве второго ключа, чтобы порядок был однозначным."""
+    field = sort_by.lstrip('-')
+    if field == 'id':
+        return [sort_by]
+    return [sort_by, '-id' if sort_by.startswith('-') else 'id']
+
+
+def encode_cursor(sort_by, obj):
+    """obj - объект модели или строка из .values()."""
+    field = sort_by.lstrip('-')
+    if isinstance(obj, dict):
+        value, pk = obj[field], obj['id']
+    else:
+        value, pk = getattr(obj, field), obj.pk
+    if isinstance(value, Decimal):
+        value = str(value)
+    raw = json.dumps([sort_by, value, pk], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(sort_by, cursor):
+    if not isinstance(cursor, str):
+        raise InvalidCursor(cursor)
+    try:
+        saved_sort_by, value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        raise InvalidCursor(cursor)
+    # Курсор привязан к сортировке, с которой он был выдан
+    if saved_sort_by != sort_by or not isinstance(pk, int):
+        raise InvalidCursor(cursor)
+    if sort_by.lstrip('-') == 'price':
+        try:
+            value = Decimal(value)
+        except (InvalidOperation, TypeError):
+            raise InvalidCursor(cursor)
+    return value, pk
+
+
+def keyset_filter(sort_by, value, pk):
+    """Условие "строго после (value, pk)" в порядке keyset_ordering(sort_by).
+
+    Первое условие (field >= value) задаёт диапазон по индексу, поэтому
+    глубокие страницы стоят столько же, сколько первая.
+    """
+    field = sort_by.lstrip('-')
+    op = 'lt' if sort_by.startswith('-') else 'gt'
+    if field == 'id':
+        return Q(**{f'id__{op}': pk})
+    return Q(**{f'{field}__{op}e': value}) & (Q(**{f'{field}__{op}': value}) | Q(**{f'id__{op}': pk}))
+
+
+def _keyset_page_queryset(queryset, sort_by, cursor, page_size):
+    queryset = queryset.order_by(*keyset_ordering(sort_by))
+    if cursor:
+        value, pk = decode_cursor(sort_by, cursor)
+        queryset = queryset.filter(keyset_filter(sort_by, value, pk))
+    # Лишняя строка показывает, есть ли следующая страница
+    return queryset[:page_size + 1]
+
+
+def _split_page(page, sort_by, page_size):
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, encode_cursor(sort_by, page[-1])
+
+
+def paginate_keyset(queryset, sort_by, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """Возвращает (объекты страницы, курсор следующей страницы или None)."""
+    page = list(_keyset_page_queryset(queryset, sort_by, cursor, page_size))
+    return _split_page(page, sort_by, page_size)
+
+
+async def apaginate_keyset(queryset, sort_by, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """paginate_keyset() для асинхронных представлений."""
+    page = [obj async for obj in _keyset_page_queryset(queryset, sort_by, cursor, page_size)]
+    return _split_page(page, sort_by, page_size)
+
+
+def parse_page_size(value):
+    if value in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    page_size = int(value)
+    if page_size < 1:
+        raise ValueError(value)
+    return min(page_size, MAX_PAGE_SIZE)
@@ -0,0 +1,152 @@
+import threading
+import time
+import uuid
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+
+class PaymentGatewayUnavailable(Exception):
+    """Шлюз не ответил после всех повторов или автомат разомкнут."""
+
+
+class CircuitBreaker:
+    """Автомат: после failure_threshold неудачных вызовов подряд шлюз не вызывается
+    reset_timeout секунд, затем пропускается один пробный вызов.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self._probing = False
+
+
+class YooKassaClient:
+    """Клиент API ЮKassa с пулом keep-alive соединений, таймаутами и повторами.
+
+    Повторы отправляются с тем же Idempotence-Key, поэтому не создают второй платёж.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url=None, auth=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff=None, pool_size=None, breaker=None):
+        config = settings.YOOKASSA_CLIENT
+        self.base_url = (base_url or settings.YOOKASSA_API_URL).rstrip('/')
+        self.timeout = (
+            connect_timeout if connect_timeout is not None else config['CONNECT_TIMEOUT'],
+            read_timeout if read_timeout is not None else config['READ_TIMEOUT'],
+        )
+        self.max_retries = max_retries if max_retries is not None else config['MAX_RETRIES']
+        self.backoff = backoff if backoff is not None else config['BACKOFF']
+        self.breaker = breaker or CircuitBreaker(config['BREAKER_THRESHOLD'], config['BREAKER_RESET_TIMEOUT'])
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size or config['POOL_SIZE'], max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.auth = auth or HTTPBasicAuth(settings.YOOKASSA_AUTH['login'], settings.YOOKASSA_AUTH['secret_key'])
+
+    def create_payment(self, payment_data, idempotence_key=None):
+        headers = {
+            "Content-Type": "application/json",
+            'Idempotence-Key': idempotence_key or str(uuid.uuid4()),
+        }
+        return self._post('/payments', payment_data, headers)
+
+    async def acreate_payment(self, payment_data, idempotence_key=None):
+        # Запрос выполняется в пуле потоков и не блокирует цикл событий ASGI,
+        # соединения берутся из того же пула, что и у синхронных вызовов
+        return await sync_to_async(self.create_payment, thread_sensitive=False)(payment_data, idempotence_key)
+
+    def _post(self, path, payload, headers):
+        if not self.breaker.allow():
+            raise PaymentGatewayUnavailable("Платёжный шлюз временно отключён")
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(self.base_url + path, json=payload, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = exc
+                continue
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            if response.status_code not in self.RETRY_STATUSES:
+                self.breaker.record_success()
+                return response
+            error = f"HTTP {response.status_code}"
+
+        self.breaker.record_failure()
+        raise PaymentGatewayUnavailable(f"Платёжный шлюз не ответил: {error}")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_payment_client():
+    """Общий на процесс клиент, чтобы соединения и состояние автомата переиспользовались."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = YooKassaClient()
+    return _client
+
+
+def _payment_status_key(payment_ref):
+    return f'payment-status:{payment_ref}'
+
+
+def set_payment_status(payment_ref, **data):
+    """Статус платежа в Redis: status (pending/ready/failed), user_id, order_id, confirmation_url."""
+    key = _payment_status_key(payment_ref)
+    payment = cache.get(key) or {}
+    payment.update(data)
+    cache.set(key, payment, settings.PAYMENT_STATUS_TIMEOUT)
+
+
+def get_payment_status(payment_ref):
+    return cache.get(_payment_status_key(payment_ref))
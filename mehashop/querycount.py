@@ -0,0 +1,137 @@
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger('mehashop.queries')
+
+# IN (%s, %s, ...) с разным числом параметров - один и тот же запрос
+_IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+def fingerprint(sql):
+    """Шаблон запроса без значений параметров - одинаков для всех итераций N+1."""
+    return _IN_LIST_RE.sub('IN (...)', sql)
+
+
+class QueryRecorder:
+    """Обёртка для connection.execute_wrapper: число запросов, время и отпечатки."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self, threshold=None):
+        if threshold is None:
+            threshold = settings.QUERY_INSPECTOR['DUPLICATE_THRESHOLD']
+        return {sql: n for sql, n in self.fingerprints.items() if n >= threshold}
+
+
+@contextmanager
+def record_queries():
+    recorder = QueryRecorder()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+class QueryBudgetMiddleware:
+    """Считает запросы к базе на каждый (или каждый N-й) запрос и сверяет с QUERY_BUDGETS.
+
+    В отладке результаты дописываются в заголовки X-Query-*, в продакшене
+    обрабатывается только доля SAMPLE_RATE запросов и пишется только лог.
+
+    Работает и под ASGI, не переводя асинхронные представления в поток.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _sampled():
+        config = settings.QUERY_INSPECTOR
+        return config['ENABLED'] and random.random() < config['SAMPLE_RATE']
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self._sampled():
+            return self.get_response(request)
+
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        return self._report(request, response, recorder)
+
+    async def __acall__(self, request):
+        if not self._sampled():
+            return await self.get_response(request)
+
+        # ORM асинхронных представлений выполняется в потоке sync_to_async этого запроса,
+        # поэтому обёртки подключаются к соединениям того же потока
+        queries = record_queries()
+        recorder = await sync_to_async(queries.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(queries.__exit__)(None, None, None)
+        return self._report(request, response, recorder)
+
+    def _report(self, request, response, recorder):
+        config = settings.QUERY_INSPECTOR
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        budget = settings.QUERY_BUDGETS.get(url_name)
+        duplicates = recorder.duplicates()
+        if budget is not None and recorder.count > budget:
+            logger.warning("%s %s: %d запросов при бюджете %d", request.method, request.path, recorder.count, budget)
+        for sql, n in duplicates.items():
+            logger.warning("%s %s: запрос повторён %d раз (N+1?): %s", request.method, request.path, n, sql)
+
+        if config['HEADERS']:
+            response['X-Query-Count'] = recorder.count
+            response['X-Query-Time-Ms'] = f'{recorder.duration * 1000:.1f}'
+            response['X-Query-Duplicates'] = sum(duplicates.values())
+        return response
+
+
+class QueryBudgetMixin:
+    """Примесь для TestCase: бюджеты запросов на эндпоинты.
+
+    Бюджет берётся из query_budgets тестового класса, а если его там нет - из
+    settings.QUERY_BUDGETS.
+    """
+    query_budgets = {}
+
+    @contextmanager
+    def assertQueryBudget(self, url_name, allow_duplicates=False):
+        budget = self.query_budgets.get(url_name, settings.QUERY_BUDGETS.get(url_name))
+        if budget is None:
+            self.fail(f"Для {url_name} не задан бюджет запросов")
+        with record_queries() as recorder:
+            yield recorder
+        if recorder.count > budget:
+            self.fail(f"{url_name}: {recorder.count} запросов при бюджете {budget}")
+        duplicates = recorder.duplicates()
+        if duplicates and not allow_duplicates:
+            self.fail(f"{url_name}: повторяющиеся запросы (N+1?): {duplicates}")
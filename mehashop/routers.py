@@ -0,0 +1,139 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+# Состояние текущего запроса (задаётся ReplicaPinningMiddleware): pinned - все чтения
+# идут в основную базу, wrote - запрос уже писал в основную базу
+_request_state = ContextVar('mehashop_replica_state', default=None)
+_primary_pinned = ContextVar('mehashop_primary_pinned', default=False)
+
+_WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+@contextmanager
+def use_primary():
+    """Чтения каталога внутри блока идут в основную базу, а не в реплики.
+
+    Нужно там, где прочитанное надолго кладётся в кэш: данные с отстающей реплики
+    пережили бы сброс кэша, сделанный сигналом сразу после записи.
+    """
+    token = _primary_pinned.set(True)
+    try:
+        yield
+    finally:
+        _primary_pinned.reset(token)
+
+
+def _reads_from_primary():
+    state = _request_state.get()
+    if _primary_pinned.get() or (state is not None and (state['pinned'] or state['wrote'])):
+        return True
+    # Внутри транзакции чтения должны видеть её же записи и блокировки
+    return connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+class ReadReplicaRouter:
+    """Чтения моделей каталога (REPLICA_READ_MODELS) - со случайной реплики из
+    DATABASE_REPLICAS, всё остальное (корзины, заказы, платежи) и все записи - в основную базу.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas or model._meta.label_lower not in settings.REPLICA_READ_MODELS:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Связанные объекты читаются оттуда же, откуда прочитан сам объект
+            return instance._state.db
+        if _reads_from_primary():
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики - копии основной базы
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class _WriteTracker:
+    """Обёртка для execute_wrapper основной базы: отмечает в state, что запрос что-то изменил.
+
+    Смотрит на сами запросы, а не на db_for_write: тот вызывается и тогда, когда
+    ничего не пишется (например, при присваивании связанного объекта новой модели).
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __call__(self, execute, sql, params, many, context):
+        if not self.state['wrote'] and sql.lstrip()[:6].upper() in _WRITE_STATEMENTS:
+            self.state['wrote'] = True
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def _track_writes(state):
+    # Соединение берётся при входе - в потоке, где будут выполняться запросы
+    with connections[DEFAULT_DB_ALIAS].execute_wrapper(_WriteTracker(state)):
+        yield
+
+
+class ReplicaPinningMiddleware:
+    """Чтение своих записей: после запроса, который писал в основную базу, клиент
+    REPLICA_PIN_SECONDS секунд (пока реплики догоняют) читает каталог только из основной базы,
+    а в самом запросе чтения после первой записи тоже идут в основную базу.
+
+    Отметка хранится в cookie REPLICA_PIN_COOKIE.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = self._start(request)
+        try:
+            with _track_writes(state):
+                response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+        return self._finish(state, response)
+
+    async def __acall__(self, request):
+        state, token = self._start(request)
+        # Как в QueryBudgetMiddleware: ORM выполняется в потоке sync_to_async этого запроса
+        tracking = _track_writes(state)
+        await sync_to_async(tracking.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(tracking.__exit__)(None, None, None)
+            _request_state.reset(token)
+        return self._finish(state, response)
+
+    @staticmethod
+    def _start(request):
+        state = {'pinned': settings.REPLICA_PIN_COOKIE in request.COOKIES, 'wrote': False}
+        return state, _request_state.set(state)
+
+    @staticmethod
+    def _finish(state, response):
+        if state['wrote'] and settings.DATABASE_REPLICAS:
+            response.set_cookie(settings.REPLICA_PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
@@ -1,11 +1,105 @@
 from rest_framework import serializers
 from pydantic import BaseModel
+from .images import image_srcset
 from .models import Product, Category, Cart, CartItem, Order
 
 class ProductSerializer(serializers.ModelSerializer):
+    # {"webp": "... 320w, ... 640w", "jpeg": "..."} - для <source srcset>; пусто, пока миниатюр нет
+    image_srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'image', 'price', 'category', 'attributes']
+        fields = ['id', 'name', 'description', 'image', 'image_srcset', 'price', 'category', 'attributes']
+
+    def __init__(self, *args, fields=None, **kwargs):
+        # fields - подмножество полей из parse_product_fields()
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    def get_image_srcset(self, product):
+        request = self.context.get('request')
+        build_url = request.build_absolute_uri if request is not None else None
+        # Хранилище - из поля модели: при fields=image_srcset колонка image не загружена
+        return image_srcset(product.image_variants, Product._meta.get_field('image').storage, build_url)
+
+
+# Колонки для быстрой сериализации: поле ProductSerializer -> колонка в .values()
+PRODUCT_VALUES = {
+    'id': 'id',
+    'name': 'name',
+    'description': 'description',
+    'image': 'image',
+    'image_srcset': 'image_variants',
+    'price': 'price',
+    'category': 'category_id',
+    'attributes': 'attributes',
+}
+
+
+def _split_fields(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [str(name).strip() for name in value if str(name).strip()]
+
+
+def parse_product_fields(fields=None, exclude=None):
+    """Поля товара для разреженного ответа по параметрам fields/exclude.
+
+    Параметры - строка через запятую или список. id возвращается всегда.
+    ValueError со списком неизвестных полей, если такие есть.
+    """
+    selected = _split_fields(fields) or list(PRODUCT_VALUES)
+    excluded = _split_fields(exclude)
+    unknown = sorted(set(selected + excluded) - set(PRODUCT_VALUES))
+    if unknown:
+        raise ValueError(unknown)
+    return [name for name in PRODUCT_VALUES if name == 'id' or (name in selected and name not in excluded)]
+
+
+def product_only_fields(fields):
+    """Аргументы для .only(): колонки, которые не попали в ответ, из базы не читаются."""
+    return ['image_variants' if name == 'image_srcset' else name for name in fields]
+
+
+def product_rows(queryset, fields=None, extra=()):
+    """Строки .values() для serialize_product_rows(); extra - дополнительные колонки (например, ключ сортировки)."""
+    columns = [PRODUCT_VALUES[name] for name in fields or PRODUCT_VALUES]
+    return queryset.values(*columns, *(column for column in extra if column not in columns))
+
+
+def serialize_product_rows(rows, request=None, fields=None):
+    """Быстрый путь для списков: словари из строк product_rows() без ModelSerializer.
+
+    Результат совпадает с ProductSerializer(..., many=True, fields=fields).data.
+    """
+    fields = fields or list(PRODUCT_VALUES)
+    columns = [(name, PRODUCT_VALUES[name]) for name in fields]
+    with_image = 'image' in fields
+    with_srcset = 'image_srcset' in fields
+    with_price = 'price' in fields
+    storage = Product._meta.get_field('image').storage
+    build_url = request.build_absolute_uri if request is not None else None
+    result = []
+    for row in rows:
+        item = {name: row[column] for name, column in columns}
+        if with_image:
+            image = item['image']
+            if image:
+                image = storage.url(image)
+                if build_url is not None:
+                    image = build_url(image)
+            item['image'] = image or None
+        if with_srcset:
+            item['image_srcset'] = image_srcset(item['image_srcset'], storage, build_url)
+        if with_price:
+            # Как DecimalField в DRF: строка с фиксированной точкой
+            item['price'] = format(item['price'], 'f')
+        result.append(item)
+    return result
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
@@ -18,6 +112,20 @@ class CartItemSerializer(serializers.ModelSerializer):
         model = CartItem
         fields = ['id', 'product', 'quantity']
 
+class CartOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=['add', 'update', 'remove'])
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0, default=1)
+
+    def validate(self, attrs):
+        if attrs['op'] == 'add' and attrs['quantity'] < 1:
+            raise serializers.ValidationError("Количество должно быть больше нуля")
+        return attrs
+
+class CartSummarySerializer(serializers.Serializer):
+    item_count = serializers.IntegerField()
+    subtotal = serializers.DecimalField(max_digits=12, decimal_places=2)
+
 class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
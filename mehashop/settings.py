@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -36,6 +37,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mehashop.querycount.QueryBudgetMiddleware',
+    'mehashop.routers.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +51,9 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'mehashop.urls'
 
+# Асинхронные представления каталога (mehashop.async_views); asgi.py включает их по умолчанию
+ASYNC_CATALOG_VIEWS = os.getenv('ASYNC_CATALOG_VIEWS', 'False') == 'True'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -76,9 +82,27 @@ DATABASES = {
         'PASSWORD': os.getenv('DATABASE_PASSWORD'),
         'HOST': os.getenv('DATABASE_HOST'),
         'PORT': os.getenv('DATABASE_PORT'),
+        # Соединение переиспользуется запросами одного потока CONN_MAX_AGE секунд
+        # и проверяется перед повторным использованием. Под ASGI - 0 (см. asgi.py):
+        # там каждый запрос выполняется в своём потоке и соединения не переиспользуются
+        'CONN_MAX_AGE': int(os.getenv('DATABASE_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Реплики для чтения каталога: DATABASE_REPLICA_HOSTS=host1,host2 (остальные параметры - как у default)
+DATABASE_REPLICAS = []
+for number, host in enumerate(filter(None, os.getenv('DATABASE_REPLICA_HOSTS', '').split(','))):
+    DATABASES[f'replica_{number}'] = dict(DATABASES['default'], HOST=host.strip(), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(f'replica_{number}')
+
+DATABASE_ROUTERS = ['mehashop.routers.ReadReplicaRouter']
+# Модели, которые можно читать с реплик
+REPLICA_READ_MODELS = {'mehashop.product', 'mehashop.category'}
+# Сколько секунд после записи клиент читает каталог из основной базы (с запасом на отставание реплик)
+REPLICA_PIN_SECONDS = 10
+REPLICA_PIN_COOKIE = 'primary_pin'
+
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -104,20 +128,114 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Миниатюры изображений товаров: ширины в пикселях, форматы и качество сжатия.
+# Создаются задачей generate_product_thumbnails после загрузки изображения
+PRODUCT_THUMBNAILS = {
+    'WIDTHS': [320, 640, 1024],
+    'FORMATS': ['webp', 'jpeg'],
+    'QUALITY': 80,
+}
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'mehashop.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
-    ]
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'mehashop.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/1')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
+
+# Кэш списка категорий сбрасывается сигналами, таймаут - страховка
+CATEGORY_CACHE_TIMEOUT = 60 * 60 * 24
+# Пользователь токена для CachedTokenAuthentication (сбрасывается при выходе и сохранении пользователя)
+AUTH_TOKEN_CACHE_TIMEOUT = 60 * 5
+# Данные отдельных товаров для корзины и оформления заказа (сбрасываются при сохранении товара)
+PRODUCT_CACHE_TIMEOUT = 60 * 60
+# Фасеты по атрибутам товаров (сбрасываются и при изменении товаров)
+PRODUCT_FACETS_TIMEOUT = 60 * 10
+# Cache-Control карточки товара: CDN держит её s_maxage секунд и проверяет по ETag
+PRODUCT_CACHE_CONTROL = {
+    'public': True,
+    'max_age': 60,
+    's_maxage': 300,
+    'stale_while_revalidate': 60,
+}
+
+# Подсказки по названиям товаров из памяти процесса (mehashop.suggest)
+SUGGEST_INDEX = {
+    # Сколько последних товаров попадает в индекс при построении
+    'MAX_PRODUCTS': 200000,
+    # Ключи строятся с начала первых MAX_WORDS слов названия и обрезаются до MAX_KEY_LENGTH символов
+    'MAX_WORDS': 3,
+    'MAX_KEY_LENGTH': 24,
+    # Как часто (в секундах) сверять версию индекса с Redis
+    'CHECK_INTERVAL': 5,
+    'LIMIT': 10,
+}
+
+# Поиск товаров ранжирует не больше стольких совпадений (см. ProductQuerySet.search)
+PRODUCT_SEARCH_CANDIDATES = 500
+
+# Сколько хранится статус платежа, созданного задачей mehashop.task.create_payment
+PAYMENT_STATUS_TIMEOUT = 60 * 60
+
+# Обработка уведомлений ЮKassa: 'sync' - прямо в запросе, 'queue' - запрос только кладёт
+# событие в Redis, а задача mehashop.task.drain_webhook_queue применяет их пачками
+YOOKASSA_WEBHOOK_MODE = os.getenv('YOOKASSA_WEBHOOK_MODE', 'sync')
+WEBHOOK_QUEUE_BATCH_SIZE = 500
+# Блокировка разбора очереди, секунд; продлевается на каждую пачку
+WEBHOOK_LOCK_TIMEOUT = 60
+# Сколько секунд повторять уведомления о платежах, заказ которых ещё не найден
+WEBHOOK_RETRY_SECONDS = 60 * 60
+
+CELERY_BEAT_SCHEDULE = {
+    'drain-yookassa-webhooks': {
+        'task': 'mehashop.task.drain_webhook_queue',
+        'schedule': 1.0,
+    },
+}
+
+# Учёт запросов к базе (mehashop.querycount.QueryBudgetMiddleware)
+QUERY_INSPECTOR = {
+    'ENABLED': os.getenv('QUERY_INSPECTOR_ENABLED', 'True') == 'True',
+    # В продакшене проверяется только доля запросов
+    'SAMPLE_RATE': 1.0 if DEBUG else float(os.getenv('QUERY_INSPECTOR_SAMPLE_RATE', '0.01')),
+    # Заголовки X-Query-* только в отладке
+    'HEADERS': DEBUG,
+    # Сколько раз один шаблон запроса может повториться, прежде чем это считается N+1
+    'DUPLICATE_THRESHOLD': 3,
+}
+
+# Максимальное число запросов к базе по имени url
+QUERY_BUDGETS = {
+    'product-list': 3,
+    'product-detail': 3,
+    'product-facets': 2,
+    'product-search': 3,
+    'product-suggest': 1,
+    'category-list': 2,
+    'cart': 6,
+    'order-create': 8,
+}
+
 AUTHENTICATION_BACKENDS = (
     'social_core.backends.vk.VKOAuth2',
     'social_core.backends.yandex.YandexOAuth2',
@@ -149,3 +267,39 @@ YOOKASSA_AUTH = {
     'login': os.getenv('YOOKASSA_LOGIN'),
     'secret_key': os.getenv('YOOKASSA_SECRET_KEY'),
 }
+
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+
+# Настройки mehashop.payments.YooKassaClient
+YOOKASSA_CLIENT = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    # Повторы при сетевых ошибках и ответах 429/5xx, с тем же Idempotence-Key
+    'MAX_RETRIES': 2,
+    'BACKOFF': 0.5,
+    # Размер пула keep-alive соединений
+    'POOL_SIZE': 10,
+    # После стольких неудачных вызовов подряд шлюз не вызывается BREAKER_RESET_TIMEOUT секунд
+    'BREAKER_THRESHOLD': 5,
+    'BREAKER_RESET_TIMEOUT': 30,
+}
+
+
+# Тесты запускаются без Redis и без воркеров Celery
+TESTING = 'test' in sys.argv
+
+if TESTING:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    # Реплика в тестах - отдельное соединение к той же базе; чтения направляются
+    # на неё только в тестах с override_settings(DATABASE_REPLICAS=['replica'])
+    DATABASES = {
+        'default': DATABASES['default'],
+        'replica': dict(DATABASES['default'], TEST={'MIRROR': 'default'}),
+    }
+    DATABASE_REPLICAS = []
+    CELERY_TASK_ALWAYS_EAGER = True
+    CELERY_TASK_EAGER_PROPAGATES = True
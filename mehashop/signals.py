@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+from django.db import transaction
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .cache import invalidate_auth_tokens, invalidate_categories, invalidate_product_facets, invalidate_products
+from .models import Cart, CartItem, Category, Product
+from .suggest import product_changed
+from .task import delete_product_thumbnails, generate_product_thumbnails
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, **kwargs):
+    # Как и для товаров (_invalidate_product): ещё раз после коммита
+    invalidate_categories()
+    transaction.on_commit(invalidate_categories)
+
+
+def _invalidate_product(product_id):
+    # Второй раз - после коммита: параллельный запрос мог успеть положить в кэш
+    # ещё не изменённую строку между первым удалением и коммитом
+    invalidate_products([product_id])
+    transaction.on_commit(lambda: invalidate_products([product_id]))
+
+
+def _invalidate_auth_tokens(token_keys):
+    # Как и для товаров: ещё раз после коммита
+    invalidate_auth_tokens(token_keys)
+    transaction.on_commit(lambda: invalidate_auth_tokens(token_keys))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    # Выход (LogoutView удаляет токен) и отзыв токена
+    _invalidate_auth_tokens([instance.key])
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, created, **kwargs):
+    # В кэше авторизации лежит сам пользователь: смена пароля, is_active и прав должна его сбросить.
+    # При удалении пользователя токены удаляются каскадом и сбрасываются в token_deleted
+    if not created:
+        _invalidate_auth_tokens(list(Token.objects.filter(user_id=instance.pk).values_list('key', flat=True)))
+
+
+def _thumbnails_outdated(product):
+    # Без загрузки отложенных полей: товар мог быть прочитан через .only()
+    if {'image', 'image_variants'} & product.get_deferred_fields():
+        return False
+    return product.image_variants.get('source') != product.image.name
+
+
+@receiver(pre_save, sender=Product)
+def product_saving(sender, instance, **kwargs):
+    # Миниатюры прежнего изображения не должны попадать в ответы, их файлы удаляются после коммита
+    if _thumbnails_outdated(instance) and instance.image_variants:
+        instance._replaced_thumbnails = instance.image_variants
+        instance.image_variants = {}
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, **kwargs):
+    _invalidate_product(instance.pk)
+    if _thumbnails_outdated(instance) and instance.image:
+        product_id = instance.pk
+        transaction.on_commit(lambda: generate_product_thumbnails.delay(product_id))
+    replaced = instance.__dict__.pop('_replaced_thumbnails', None)
+    if replaced:
+        transaction.on_commit(lambda: delete_product_thumbnails.delay(replaced))
+    invalidate_product_facets()
+    # Подсказки зависят только от названия. Версия увеличивается после коммита: иначе другие
+    # процессы перестроили бы индекс по ещё не закоммиченным данным
+    loaded_name = getattr(instance, '_loaded_name', None)
+    if created or ('name' not in instance.get_deferred_fields() and instance.name != loaded_name):
+        product_id, name = instance.pk, instance.name
+        instance._loaded_name = name
+        transaction.on_commit(lambda: product_changed(product_id, name))
+    # Цена могла измениться - пересчитываем итоги корзин, где лежит товар
+    if not created:
+        Cart.objects.filter(cartitem__product=instance).refresh_totals()
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleting(sender, instance, **kwargs):
+    # Позиции удалятся каскадом, поэтому корзины запоминаем заранее
+    instance._affected_cart_ids = list(CartItem.objects.filter(product=instance).values_list('cart_id', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    _invalidate_product(instance.pk)
+    invalidate_product_facets()
+    product_id = instance.pk
+    transaction.on_commit(lambda: product_changed(product_id))
+    cart_ids = getattr(instance, '_affected_cart_ids', None)
+    if cart_ids:
+        Cart.objects.filter(pk__in=cart_ids).refresh_totals()
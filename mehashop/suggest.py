@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from .models import Product
+from .routers import use_primary
+
+
+# Номер версии каталога для подсказок: увеличивается при каждом изменении товара,
+# по нему остальные процессы узнают, что их индекс устарел
+SUGGEST_VERSION_KEY = 'suggest:version'
+
+logger = logging.getLogger('mehashop.suggest')
+
+
+def normalize(text):
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+
+def _keys(name, max_words, max_length):
+    """Ключи индекса: название с начала каждого слова, чтобы "шу" находило "Норковая шуба"."""
+    words = name.lower().replace('ё', 'е').split()
+    return {' '.join(words[i:])[:max_length] for i in range(min(len(words), max_words))}
+
+
+class SuggestIndex:
+    """Префиксный индекс названий товаров в памяти процесса.
+
+    Отсортированный список ключей и параллельный массив id товаров: поиск -
+    bisect по префиксу, добавление и удаление - вставка и удаление по позиции.
+    """
+
+    def __init__(self, products=(), version=None):
+        self.version = version
+        self.names = {}
+        entries = []
+        # Одинаковые (после обрезки) ключи разных товаров хранятся одной строкой
+        shared = {}
+        max_words, max_length = self._limits()
+        for product_id, name in products:
+            self.names[product_id] = name
+            for key in _keys(name, max_words, max_length):
+                entries.append((shared.setdefault(key, key), product_id))
+        entries.sort()
+        self.keys = [key for key, _ in entries]
+        self.ids = array('q', (product_id for _, product_id in entries))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _limits():
+        config = settings.SUGGEST_INDEX
+        return config['MAX_WORDS'], config['MAX_KEY_LENGTH']
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, prefix, limit=None):
+        """[(id, название)] товаров, у которых одно из слов названия начинается с prefix."""
+        prefix = normalize(prefix)[:settings.SUGGEST_INDEX['MAX_KEY_LENGTH']]
+        limit = limit or settings.SUGGEST_INDEX['LIMIT']
+        result = {}
+        if not prefix:
+            return []
+        with self._lock:
+            position = bisect_left(self.keys, prefix)
+            while position < len(self.keys) and len(result) < limit and self.keys[position].startswith(prefix):
+                product_id = self.ids[position]
+                result.setdefault(product_id, self.names[product_id])
+                position += 1
+        return list(result.items())
+
+    def add(self, product_id, name):
+        with self._lock:
+            self._remove(product_id)
+            if len(self.names) >= settings.SUGGEST_INDEX['MAX_PRODUCTS']:
+                # Как при построении: в индексе только MAX_PRODUCTS последних товаров
+                oldest = min(self.names)
+                if product_id < oldest:
+                    return
+                self._remove(oldest)
+            self.names[product_id] = name
+            for key in _keys(name, *self._limits()):
+                position = bisect_left(self.keys, key)
+                while position < len(self.keys) and self.keys[position] == key and self.ids[position] < product_id:
+                    position += 1
+                self.keys.insert(position, key)
+                self.ids.insert(position, product_id)
+
+    def remove(self, product_id):
+        with self._lock:
+            self._remove(product_id)
+
+    def _remove(self, product_id):
+        name = self.names.pop(product_id, None)
+        if name is None:
+            return
+        for key in _keys(name, *self._limits()):
+            position = bisect_left(self.keys, key)
+            while position < len(self.keys) and self.keys[position] == key:
+                if self.ids[position] == product_id:
+                    del self.keys[position]
+                    del self.ids[position]
+                    break
+                position += 1
+
+
+def build_index():
+    # Версия читается до загрузки: изменения во время загрузки приведут к ещё одной перестройке
+    version = cache.get_or_set(SUGGEST_VERSION_KEY, 0, None)
+    products = (
+        Product.objects.order_by('-id').values_list('id', 'name')[:settings.SUGGEST_INDEX['MAX_PRODUCTS']]
+    )
+    # Как загрузчики cache.py: индекс с отстающей реплики жил бы до следующего изменения каталога
+    with use_primary():
+        return SuggestIndex(products.iterator(chunk_size=5000), version)
+
+
+_index = None
+_checked_at = 0.0
+_build_lock = threading.Lock()
+_rebuild_thread = None
+
+
+def _rebuild_index():
+    global _index
+    index = build_index()
+    with _build_lock:
+        _index = index
+
+
+def _rebuild_worker():
+    global _rebuild_thread
+    try:
+        _rebuild_index()
+    except Exception:
+        logger.exception("Не удалось перестроить индекс подсказок")
+    finally:
+        _rebuild_thread = None
+        # Соединение этого потока больше не понадобится
+        connections.close_all()
+
+
+def _schedule_rebuild():
+    """Перестраивает индекс в фоновом потоке; одновременно идёт не больше одной перестройки."""
+    global _rebuild_thread
+    with _build_lock:
+        if _rebuild_thread is not None:
+            return
+        _rebuild_thread = threading.Thread(target=_rebuild_worker, name='suggest-rebuild', daemon=True)
+    _rebuild_thread.start()
+
+
+def get_suggest_index():
+    """Индекс процесса. Строится при первом обращении (обычно - в warm_suggest_index при старте).
+
+    Если товары менялись в другом процессе (проверка версии в Redis не чаще CHECK_INTERVAL
+    секунд), индекс перестраивается в фоновом потоке, а запросы до конца перестройки
+    получают прежний: подсказки не ждут загрузки всего каталога из базы.
+    """
+    global _index, _checked_at
+    index = _index
+    if index is None:
+        with _build_lock:
+            if _index is None:
+                _index = build_index()
+                _checked_at = time.monotonic()
+            return _index
+    now = time.monotonic()
+    if now - _checked_at >= settings.SUGGEST_INDEX['CHECK_INTERVAL']:
+        _checked_at = now
+        if cache.get(SUGGEST_VERSION_KEY) != index.version:
+            _schedule_rebuild()
+    return index
+
+
+def warm_suggest_index():
+    """Строит индекс при старте процесса (wsgi.py / asgi.py), чтобы его не ждал первый запрос.
+
+    Ошибка только пишется в лог: индекс тогда построится при первом обращении.
+    """
+    try:
+        get_suggest_index()
+    except Exception:
+        logger.exception("Не удалось построить индекс подсказок")
+    finally:
+        # Соединение не должно достаться дочерним процессам, если сервер форкает воркеры
+        connections.close_all()
+
+
+def _bump_version():
+    try:
+        return cache.incr(SUGGEST_VERSION_KEY)
+    except ValueError:
+        cache.add(SUGGEST_VERSION_KEY, 0, None)
+        return cache.incr(SUGGEST_VERSION_KEY)
+
+
+def product_changed(product_id, name=None):
+    """Вызывается из сигналов после коммита: правит индекс этого процесса и увеличивает общую версию.
+
+    name=None - товар удалён.
+    """
+    index = _index
+    if index is not None:
+        if name is None:
+            index.remove(product_id)
+        else:
+            index.add(product_id, name)
+    version = _bump_version()
+    # Если версию за это время увеличил кто-то ещё, индекс перестроится при следующей проверке
+    if index is not None and index.version is not None and version == index.version + 1:
+        index.version = version
+
+
+def catalog_changed():
+    """Массовое изменение товаров (import_catalog): индексы всех процессов, включая этот,
+    перестроятся при следующей проверке версии.
+    """
+    _bump_version()
+
+
+def reset_suggest_index():
+    global _index
+    with _build_lock:
+        _index = None
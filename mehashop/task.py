@@ -1,6 +1,119 @@
+import logging
+
 from celery import shared_task
+from django.conf import settings
+from PIL import UnidentifiedImageError
+
+from .cache import invalidate_products
+from .images import delete_thumbnails, render_thumbnails, store_thumbnails
+from .models import Order, Product
+from .payments import PaymentGatewayUnavailable, get_payment_client, set_payment_status
+from .routers import use_primary
+from . import webhooks
+
+logger = logging.getLogger('mehashop.images')
+payments_logger = logging.getLogger('mehashop.payments')
 
 @shared_task
 def send_order_notification(order_id):
     # Логика отправки уведомления
-    print(f"Заказ {order_id} создан")
\ No newline at end of file
+    print(f"Заказ {order_id} создан")
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=5)
+def create_payment(self, order_id, payment_ref):
+    # payment_ref служит ключом идемпотентности: повторы задачи не создают второй платёж
+    order = Order.objects.get(id=order_id)
+    payment_data = {
+        "amount": {"value": str(order.total_price), "currency": "RUB"},
+        "capture": True,
+        "confirmation": {
+            "type": "redirect",
+            "return_url": "https://yourdomain.com/payment-success"
+        },
+        "description": f"Оплата заказа №{order.id}"
+    }
+
+    try:
+        response = get_payment_client().create_payment(payment_data, payment_ref)
+    except PaymentGatewayUnavailable as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc)
+        set_payment_status(payment_ref, status='failed')
+        return
+
+    if response.status_code != 200:
+        set_payment_status(payment_ref, status='failed')
+        return
+    try:
+        data = response.json()
+        payment_id, payment_status = data['id'], data['status']
+        confirmation_url = data['confirmation']['confirmation_url']
+    except (KeyError, TypeError, ValueError):
+        # Иначе статус оставался бы pending до истечения PAYMENT_STATUS_TIMEOUT
+        payments_logger.exception("Неправильный ответ ЮKassa на создание платежа %s", payment_ref)
+        set_payment_status(payment_ref, status='failed')
+        return
+    order.payment_id = payment_id
+    order.payment_status = payment_status
+    order.payment_method = "YooKassa"
+    order.save(update_fields=['payment_id', 'payment_status', 'payment_method'])
+    set_payment_status(payment_ref, status='ready', confirmation_url=confirmation_url)
+
+
+@shared_task(ignore_result=True)
+def drain_webhook_queue():
+    # Запускается по расписанию CELERY_BEAT_SCHEDULE в режиме YOOKASSA_WEBHOOK_MODE = 'queue'
+    return webhooks.drain_webhook_queue()
+
+
+def save_product_thumbnails(product_id, source, rendered):
+    """Сохраняет миниатюры изображения source и записывает их в товар.
+
+    Если изображение товара за это время сменилось, файлы не пишутся и товар не меняется.
+    Возвращает, записаны ли миниатюры.
+    """
+    products = Product.objects.filter(pk=product_id, image=source)
+    with use_primary():
+        if not products.exists():
+            return False
+    storage = Product._meta.get_field('image').storage
+    variants = store_thumbnails(storage, source, rendered)
+    if not products.set_image_variants(source, variants):
+        # Изображение сменилось уже после проверки
+        delete_product_thumbnails(variants)
+        return False
+    invalidate_products([product_id])
+    return True
+
+
+@shared_task(bind=True, ignore_result=True, max_retries=3, default_retry_delay=30)
+def generate_product_thumbnails(self, product_id):
+    # Запускается сигналом после сохранения товара с новым изображением
+    with use_primary():
+        product = Product.objects.only('image').filter(pk=product_id).first()
+    if product is None or not product.image:
+        return
+    source = product.image.name
+    try:
+        with product.image.open('rb') as image:
+            data = image.read()
+    except OSError as exc:
+        raise self.retry(exc=exc)
+    config = settings.PRODUCT_THUMBNAILS
+    try:
+        rendered = render_thumbnails(data, config['WIDTHS'], config['FORMATS'], config['QUALITY'])
+    except (UnidentifiedImageError, OSError):
+        logger.exception("Не удалось построить миниатюры товара %s (%s)", product_id, source)
+        return
+    save_product_thumbnails(product_id, source, rendered)
+
+
+@shared_task(ignore_result=True)
+def delete_product_thumbnails(variants):
+    # Запускается после смены изображения товара. Файлы остаются, если на то же
+    # изображение ссылается другой товар: у них общие миниатюры
+    with use_primary():
+        in_use = Product.objects.filter(image_variants__source=variants.get('source')).exists()
+    if not in_use:
+        delete_thumbnails(Product._meta.get_field('image').storage, variants)
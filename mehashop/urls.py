@@ -1,20 +1,32 @@
+from django.conf import settings
 from django.urls import path, include
 from dj_rest_auth.views import LogoutView
 from .views import (
-    ProductListView, ProductDetailView, CategoryListView, CartView, OrderCreateView,
-    CreatePaymentView, yookassa_webhook, LoginView
+    ProductListView, ProductFacetsView, ProductSearchView, ProductSuggestView, ProductDetailView, CategoryListView, CartView, CartBatchView, CartSummaryView,
+    OrderCreateView, CreatePaymentView, PaymentStatusView, yookassa_webhook, WebhookQueueMetricsView, LoginView
 )
 
+if settings.ASYNC_CATALOG_VIEWS:
+    # Под ASGI каталог обслуживают асинхронные представления с теми же URL и ответами
+    from .async_views import ProductListView, ProductDetailView, CategoryListView  # noqa: F811
+
 urlpatterns = [
     path('products/', ProductListView.as_view(), name='product-list'),
+    path('products/facets/', ProductFacetsView.as_view(), name='product-facets'),
+    path('products/search/', ProductSearchView.as_view(), name='product-search'),
+    path('products/suggest/', ProductSuggestView.as_view(), name='product-suggest'),
     path('product/<int:product_id>/', ProductDetailView.as_view(), name='product-detail'),
     path('categories/', CategoryListView.as_view(), name='category-list'),
     path('cart/', CartView.as_view(), name='cart'),
+    path('cart/batch/', CartBatchView.as_view(), name='cart-batch'),
+    path('cart/summary/', CartSummaryView.as_view(), name='cart-summary'),
     path('order/', OrderCreateView.as_view(), name='order-create'),
 
     # Платежи
     path('payment/<int:order_id>/', CreatePaymentView.as_view(), name='create-payment'),
+    path('payment/status/<str:payment_ref>/', PaymentStatusView.as_view(), name='payment-status'),
     path('payment/webhook/yookassa/', yookassa_webhook, name='yookassa-webhook'),
+    path('payment/webhook/yookassa/metrics/', WebhookQueueMetricsView.as_view(), name='yookassa-webhook-metrics'),
 
     # Аутентификация
     path('auth/', include('dj_rest_auth.urls')),
@@ -1,162 +1,435 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import authenticate
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db import transaction
 from django.shortcuts import get_object_or_404
-from requests.auth import HTTPBasicAuth
-import requests
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+import hashlib
 import json
 import uuid
 
 from .models import Product, Category, Cart, CartItem, Order, OrderItem
-from .serializers import ProductSerializer, CategorySerializer, CartItemSerializer, OrderSerializer
+from .serializers import (
+    ProductSerializer, CartItemSerializer, CartOperationSerializer, CartSummarySerializer, OrderSerializer,
+    parse_product_fields, product_only_fields, product_rows, serialize_product_rows
+)
+from .renderers import dumps
+from .pagination import InvalidCursor, paginate_keyset, parse_page_size, keyset_ordering
+from .cache import get_category_list, get_category_tree, get_product, get_product_facets, get_products
+from .payments import get_payment_status, set_payment_status
+from .suggest import get_suggest_index
+from .task import create_payment
+from .webhooks import apply_payment_event, enqueue_webhook, webhook_queue_metrics
+
+
+STREAM_CHUNK_SIZE = 2000
+
+
+def _stream_products(products, fields):
+    # iterator() на PostgreSQL читает строки серверным курсором пачками по chunk_size
+    rows = product_rows(products, fields).iterator(chunk_size=STREAM_CHUNK_SIZE)
+    for row in rows:
+        yield dumps(serialize_product_rows([row], fields=fields)[0]) + b'\n'
+
+
+def _product_fields(params):
+    # Разреженный ответ: fields/exclude - поля товара строкой через запятую или списком
+    return parse_product_fields(params.get('fields'), params.get('exclude'))
+
+
+def _unknown_fields_response(exc):
+    return Response({"error": "Неизвестные поля", "fields": exc.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+
+PRODUCT_FILTER_PARAMS = ['category_id', 'include_descendants', 'min_price', 'max_price']
+PRODUCT_SORT_FIELDS = ['price', 'name', '-price', '-name', 'id', '-id']
+
+
+def _cart_items(items, fields=None):
+    """Позиции корзины в формате CartItemSerializer; товары берутся из кэша одним get_many."""
+    products = get_products({item['product_id'] for item in items})
+    result = []
+    for item in items:
+        product = products.get(item['product_id'])
+        if product is None:
+            continue
+        if fields is not None:
+            product = {name: product[name] for name in fields}
+        result.append({'id': item['id'], 'product': product, 'quantity': item['quantity']})
+    return result
+
+
+def _category_path_query(data):
+    """Запрос Category.path для include_descendants или None, если он не нужен."""
+    if data.get('category_id') and data.get('include_descendants'):
+        return Category.objects.filter(id=data['category_id']).values_list('path', flat=True)
+    return None
+
+
+def _filter_products(data):
+    """Товары по category_id (с include_descendants - вместе с подкатегориями) и диапазону цен."""
+    path_query = _category_path_query(data)
+    # Поддерево категории - один запрос по индексу на Category.path
+    return _apply_product_filters(data, path_query.first() if path_query is not None else None)
+
+
+def _apply_product_filters(data, category_path=None):
+    """Фильтры _filter_products(); category_path - уже прочитанный путь категории для include_descendants."""
+    category_id = data.get('category_id')
+    min_price = data.get('min_price')
+    max_price = data.get('max_price')
+
+    products = Product.objects.all()
+    if category_id:
+        if data.get('include_descendants'):
+            products = products.filter(category__path__startswith=category_path) if category_path else products.none()
+        else:
+            products = products.filter(category_id=category_id)
+    if min_price:
+        products = products.filter(price__gte=min_price)
+    if max_price:
+        products = products.filter(price__lte=max_price)
+    return products
 
 
 # POST /products - получение товаров по категории с фильтрацией и сортировкой
+# Если передан cursor или page_size, ответ постраничный: {"results": [...], "next_cursor": ...}
+# Если передан stream, товары отдаются потоком в формате NDJSON
+# include_descendants - вместе с category_id отбирает товары всех подкатегорий
+# fields / exclude - какие поля товара вернуть (остальные колонки не читаются из базы)
+# attributes - фильтр по атрибутам: {"цвет": "чёрный", "размеры": [44, 46], "длина": {"min": 100}}
 class ProductListView(APIView):
     permission_classes = [AllowAny]
     def post(self, request):
-        category_id = request.data.get('category_id')
-        min_price = request.data.get('min_price')
-        max_price = request.data.get('max_price')
         sort_by = request.data.get('sort_by', 'price')  # по умолчанию сортировка по цене
 
-        allowed_sort_fields = ['price', 'name', '-price', '-name', 'id', '-id']
-        if sort_by not in allowed_sort_fields:
+        if sort_by not in PRODUCT_SORT_FIELDS:
             return Response({"error": "Неправильный параметр сортировки"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            fields = _product_fields(request.data)
+        except ValueError as exc:
+            return _unknown_fields_response(exc)
+
+        products = _filter_products(request.data)
+        attributes = request.data.get('attributes')
+        if attributes:
+            try:
+                products = products.filter_attributes(attributes)
+            except ValueError:
+                return Response({"error": "Неправильный фильтр по атрибутам"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if request.data.get('stream'):
+            products = products.order_by(*keyset_ordering(sort_by))
+            return StreamingHttpResponse(_stream_products(products, fields), content_type='application/x-ndjson')
+
+        cursor = request.data.get('cursor')
+        if cursor or request.data.get('page_size'):
+            try:
+                page_size = parse_page_size(request.data.get('page_size'))
+            except (TypeError, ValueError):
+                return Response({"error": "Неправильный размер страницы"}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                # Ключ сортировки нужен для курсора, даже если его нет в fields
+                rows = product_rows(products, fields, extra=[sort_by.lstrip('-')])
+                page, next_cursor = paginate_keyset(rows, sort_by, cursor, page_size)
+            except InvalidCursor:
+                return Response({"error": "Неправильный курсор"}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({"results": serialize_product_rows(page, fields=fields), "next_cursor": next_cursor})
 
-        products = Product.objects.all()
-        if category_id:
-            products = products.filter(category_id=category_id)
-        if min_price:
-            products = products.filter(price__gte=min_price)
-        if max_price:
-            products = products.filter(price__lte=max_price)
         products = products.order_by(sort_by)
+        return Response(serialize_product_rows(product_rows(products, fields), fields=fields))
+
+# POST /products/facets - значения атрибутов с числом товаров для тех же
+# category_id / include_descendants / min_price / max_price, что и у списка товаров
+class ProductFacetsView(APIView):
+    permission_classes = [AllowAny]
+    def post(self, request):
+        signature = {name: request.data.get(name) for name in PRODUCT_FILTER_PARAMS}
+        return Response(get_product_facets(_filter_products(request.data), signature))
+
+# POST /products/search - полнотекстовый поиск по названию и описанию, по убыванию релевантности
+# q - строка поиска, prefix - последнее слово ищется как начало слова (для подсказок при наборе)
+# page_size - число результатов; фильтры по категории и цене, fields / exclude - как у /products
+class ProductSearchView(APIView):
+    permission_classes = [AllowAny]
+    def post(self, request):
+        text = request.data.get('q')
+        if not isinstance(text, str) or not text.strip():
+            return Response({"error": "Пустой поисковый запрос"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page_size = parse_page_size(request.data.get('page_size'))
+        except (TypeError, ValueError):
+            return Response({"error": "Неправильный размер страницы"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            fields = _product_fields(request.data)
+        except ValueError as exc:
+            return _unknown_fields_response(exc)
+
+        products = _filter_products(request.data).search(
+            text, prefix=bool(request.data.get('prefix')), candidates=settings.PRODUCT_SEARCH_CANDIDATES
+        )
+        return Response(serialize_product_rows(product_rows(products, fields)[:page_size], fields=fields))
+
+# GET /products/suggest?q=... - подсказки по названиям товаров при наборе, без запросов к базе
+class ProductSuggestView(APIView):
+    permission_classes = [AllowAny]
+    def get(self, request):
+        suggestions = get_suggest_index().lookup(request.query_params.get('q', ''))
+        return Response([{"id": product_id, "name": name} for product_id, name in suggestions])
+
+def _product_etag(product, fields, renderer_format):
+    # Сильный ETag: одна и та же версия товара в разных наборах полей и форматах - разные представления
+    version = f'{product.pk}:{product.updated_at.isoformat()}:{",".join(fields)}:{renderer_format}'
+    return '"%s"' % hashlib.md5(version.encode()).hexdigest()
+
+
+def _product_cache_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, **settings.PRODUCT_CACHE_CONTROL)
+    patch_vary_headers(response, ['Accept'])
+    return response
 
-        serializer = ProductSerializer(products, many=True)
-        return Response(serializer.data)
 
-# GET /product - получение карточки товара
+# GET /product - получение карточки товара (?fields=... / ?exclude=... - разреженный ответ)
+# Отдаёт ETag и Last-Modified; на If-None-Match / If-Modified-Since отвечает 304 без сериализации
 class ProductDetailView(APIView):
     permission_classes = [AllowAny]
     def get(self, request, product_id):
-        product = get_object_or_404(Product, id=product_id)
-        serializer = ProductSerializer(product)
-        return Response(serializer.data)
-
-# GET /categories - получение списка категорий
+        try:
+            fields = _product_fields(request.query_params)
+        except ValueError as exc:
+            return _unknown_fields_response(exc)
+        product = get_object_or_404(Product.objects.only('updated_at', *product_only_fields(fields)), id=product_id)
+
+        etag = _product_etag(product, fields, request.accepted_renderer.format)
+        last_modified = int(product.updated_at.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = Response(ProductSerializer(product, fields=fields).data)
+        return _product_cache_headers(response, etag, last_modified)
+
+# GET /categories - получение списка категорий (?tree=1 - вложенным деревом)
 class CategoryListView(APIView):
     permission_classes = [AllowAny]
     def get(self, request):
-        categories = Category.objects.all()
-        serializer = CategorySerializer(categories, many=True)
-        return Response(serializer.data)
+        if request.query_params.get('tree'):
+            data, etag = get_category_tree()
+        else:
+            data, etag = get_category_list()
+
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified['ETag'] = etag
+            return not_modified
+
+        response = Response(data)
+        response['ETag'] = etag
+        return response
 
 # GET, POST, PUT, DELETE /cart - работа с корзиной
 class CartView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
+        # ?fields=... / ?exclude=... ограничивают поля вложенного товара
+        try:
+            fields = _product_fields(request.query_params)
+        except ValueError as exc:
+            return _unknown_fields_response(exc)
         cart, _ = Cart.objects.get_or_create(user=request.user)
-        items = CartItem.objects.filter(cart=cart)
-        serializer = CartItemSerializer(items, many=True)
-        return Response(serializer.data)
+        items = CartItem.objects.filter(cart=cart).order_by('id').values('id', 'product_id', 'quantity')
+        return Response(_cart_items(items, fields))
 
     def post(self, request):
-        cart, _ = Cart.objects.get_or_create(user=request.user)
         product_id = request.data.get('product_id')
-        quantity = request.data.get('quantity', 1)
+        try:
+            quantity = int(request.data.get('quantity', 1))
+        except (TypeError, ValueError):
+            quantity = 0
+        if quantity < 1:
+            return Response({"error": "Неправильное количество"}, status=status.HTTP_400_BAD_REQUEST)
         product = get_object_or_404(Product, id=product_id)
-        cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
-        if not created:
-            cart_item.quantity += int(quantity)
-            cart_item.save()
+        with transaction.atomic():
+            # Корзина блокируется до записи позиции - в том же порядке, что в CartBatchView и OrderCreateView.
+            # Иначе изменение позиции параллельно с оформлением заказа заканчивается deadlock
+            cart, _ = Cart.objects.select_for_update().get_or_create(user=request.user)
+            # Один запрос на добавление, параллельные клики не теряют единицы товара
+            cart_item = CartItem.objects.add_quantity(cart, product, quantity)
+            Cart.objects.filter(pk=cart.pk).refresh_totals()
         serializer = CartItemSerializer(cart_item)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def put(self, request):
-        cart = get_object_or_404(Cart, user=request.user)
         item_id = request.data.get('item_id')
         quantity = request.data.get('quantity')
-        item = get_object_or_404(CartItem, id=item_id, cart=cart)
-        item.quantity = quantity
-        item.save()
-        serializer = CartItemSerializer(item)
-        return Response(serializer.data)
+        with transaction.atomic():
+            # Как в post: сначала корзина, потом позиция
+            cart = get_object_or_404(Cart.objects.select_for_update(), user=request.user)
+            item = get_object_or_404(CartItem, id=item_id, cart=cart)
+            item.quantity = quantity
+            item.save()
+            Cart.objects.filter(pk=cart.pk).refresh_totals()
+        return Response({'id': item.id, 'product': get_product(item.product_id), 'quantity': item.quantity})
 
     def delete(self, request):
-        cart = get_object_or_404(Cart, user=request.user)
         item_id = request.data.get('item_id')
-        item = get_object_or_404(CartItem, id=item_id, cart=cart)
-        item.delete()
+        with transaction.atomic():
+            # Как в post: сначала корзина, потом позиция
+            cart = get_object_or_404(Cart.objects.select_for_update(), user=request.user)
+            item = get_object_or_404(CartItem, id=item_id, cart=cart)
+            item.delete()
+            Cart.objects.filter(pk=cart.pk).refresh_totals()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+
+# POST /cart/batch - пакет операций с корзиной в одной транзакции
+# {"operations": [{"op": "add" | "update" | "remove", "product_id": 1, "quantity": 2}, ...]}
+# update с quantity=0 удаляет позицию. В ответе - итоговое содержимое корзины.
+class CartBatchView(APIView):
+    permission_classes = [IsAuthenticated]
+    MAX_OPERATIONS = 500
+
+    def post(self, request):
+        if not isinstance(request.data, dict):
+            return Response({"error": "Ожидается объект с полем operations"}, status=status.HTTP_400_BAD_REQUEST)
+        operations = request.data.get('operations', [])
+        # До валидации: огромный пакет не должен разбираться целиком
+        if isinstance(operations, list) and len(operations) > self.MAX_OPERATIONS:
+            return Response({"error": "Слишком много операций"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = CartOperationSerializer(data=operations, many=True)
+        if not serializer.is_valid():
+            return Response({"error": "Неправильные операции", "details": serializer.errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+        operations = serializer.validated_data
+
+        # Число запросов не зависит от количества операций
+        with transaction.atomic():
+            # Блокировка корзины упорядочивает пакет с оформлением заказа и другими пакетами
+            cart, _ = Cart.objects.select_for_update().get_or_create(user=request.user)
+            product_ids = {operation['product_id'] for operation in operations}
+            products = Product.objects.in_bulk(product_ids)
+            missing = sorted(product_ids - products.keys())
+            if missing:
+                return Response({"error": "Товары не найдены", "product_ids": missing},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            current = dict(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity'))
+            quantities = dict(current)
+            for operation in operations:
+                product_id, quantity = operation['product_id'], operation['quantity']
+                if operation['op'] == 'add':
+                    quantities[product_id] = quantities.get(product_id, 0) + quantity
+                elif operation['op'] == 'update' and quantity > 0:
+                    quantities[product_id] = quantity
+                else:
+                    quantities.pop(product_id, None)
+
+            removed = [product_id for product_id in current if product_id not in quantities]
+            if removed:
+                CartItem.objects.filter(cart=cart, product_id__in=removed).delete()
+            changed = [
+                CartItem(cart=cart, product_id=product_id, quantity=quantity)
+                for product_id, quantity in quantities.items() if current.get(product_id) != quantity
+            ]
+            if changed:
+                CartItem.objects.bulk_create(
+                    changed, update_conflicts=True, unique_fields=['cart', 'product'], update_fields=['quantity']
+                )
+            Cart.objects.filter(pk=cart.pk).refresh_totals()
+
+        items = CartItem.objects.filter(cart=cart).order_by('id').values('id', 'product_id', 'quantity')
+        return Response(_cart_items(items))
+
+
+# GET /cart/summary - число товаров и сумма корзины для бейджа в шапке
+class CartSummaryView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        summary = Cart.objects.filter(user=request.user).values('item_count', 'subtotal').first()
+        serializer = CartSummarySerializer(summary or {'item_count': 0, 'subtotal': 0})
+        return Response(serializer.data)
+
 # POST /order - создание заказа
 class OrderCreateView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        cart = get_object_or_404(Cart, user=request.user)
-        cart_items = CartItem.objects.filter(cart=cart)
-        if not cart_items.exists():
-            return Response({"error": "Корзина пуста"}, status=status.HTTP_400_BAD_REQUEST)
-
-        order = Order.objects.create(user=request.user)
-        for item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                product=item.product,
-                quantity=item.quantity,
-                price=item.product.price
+        # Число запросов не зависит от размера корзины
+        with transaction.atomic():
+            # Блокировка корзины не даёт оформить её дважды параллельными запросами
+            cart = get_object_or_404(Cart.objects.select_for_update(), user=request.user)
+            cart_items = list(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity'))
+            if not cart_items:
+                return Response({"error": "Корзина пуста"}, status=status.HTTP_400_BAD_REQUEST)
+            # Цены - из самих строк товаров, а не из кэша: кэш не сбрасывают update() и bulk_update().
+            # Блокировка не даёт изменить цену или удалить товар, пока заказ не закоммичен
+            prices = dict(
+                Product.objects.select_for_update().filter(pk__in={product_id for product_id, _ in cart_items})
+                .order_by('pk').values_list('pk', 'price')
             )
-        cart_items.delete()  # Очистка корзины
+            if len(prices) < len(cart_items):
+                return Response({"error": "Некоторых товаров из корзины больше нет"}, status=status.HTTP_400_BAD_REQUEST)
+
+            order = Order(user=request.user)
+            order_items = []
+            for product_id, quantity in cart_items:
+                price = prices[product_id]
+                order_items.append(OrderItem(
+                    order=order,
+                    product_id=product_id,
+                    quantity=quantity,
+                    price=price
+                ))
+                order.total_price += price * quantity
+            order.save()
+            OrderItem.objects.bulk_create(order_items)
+            CartItem.objects.filter(cart=cart).delete()  # Очистка корзины
+            Cart.objects.filter(pk=cart.pk).update(item_count=0, subtotal=0)
         serializer = OrderSerializer(order)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
+# POST /payment/<order_id> - запуск создания платежа, сам платёж создаёт задача Celery.
+# Ответ 202 со ссылкой на статус, confirmation_url появится там, когда платёж будет создан.
 class CreatePaymentView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, order_id):
+        # Сумма заказа посчитана при его создании (OrderCreateView) по ценам позиций
         order = get_object_or_404(Order, id=order_id, user=request.user)
-        order.calculate_total_price()
-
-        payment_data = {
-            "amount": {"value": str(order.total_price), "currency": "RUB"},
-            "capture": True,
-            "confirmation": {
-                "type": "redirect",
-                "return_url": "https://yourdomain.com/payment-success"
-            },
-            "description": f"Оплата заказа №{order.id}"
-        }
-
-        idempotence_key = str(uuid.uuid4())
-
-        auth = HTTPBasicAuth(settings.YOOKASSA_AUTH['login'], settings.YOOKASSA_AUTH['secret_key'])
-
-        headers = {
-            "Content-Type": "application/json",
-            'Idempotence-Key': idempotence_key,
-        }
-
-        response = requests.post("https://api.yookassa.ru/v3/payments", json=payment_data, headers=headers, auth=auth)
-
-        if response.status_code == 200:
-            data = response.json()
-            order.payment_id = data['id']
-            order.payment_status = data['status']
-            order.payment_method = "YooKassa"
-            order.save()
-            return Response({"confirmation_url": data['confirmation']['confirmation_url']})
-        else:
-            return Response({"error": "Ошибка при создании платежа"}, status=status.HTTP_400_BAD_REQUEST)
+
+        payment_ref = str(uuid.uuid4())
+        set_payment_status(payment_ref, status='pending', user_id=request.user.id, order_id=order.id)
+        create_payment.delay(order.id, payment_ref)
+        return Response(
+            {"payment_ref": payment_ref, "status_url": reverse('payment-status', args=[payment_ref])},
+            status=status.HTTP_202_ACCEPTED
+        )
+
+
+# GET /payment/status/<payment_ref> - статус платежа из Redis, без обращения к базе
+class PaymentStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, payment_ref):
+        payment = get_payment_status(payment_ref)
+        if payment is None or payment['user_id'] != request.user.id:
+            return Response({"error": "Платёж не найден"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            "order_id": payment['order_id'],
+            "status": payment['status'],
+            "confirmation_url": payment.get('confirmation_url'),
+        })
 
 
 @csrf_exempt
@@ -166,24 +439,31 @@ def yookassa_webhook(request):
             data = json.loads(request.body)
             payment_id = data.get("object", {}).get("id")
             payment_status = data.get("object", {}).get("status")
+            if not payment_id or not payment_status:
+                return JsonResponse({"error": "Неверный запрос"}, status=400)
+            event = data.get("event") or f"payment.{payment_status}"
 
-            try:
-                order = Order.objects.get(payment_id=payment_id)
-                order.payment_status = payment_status
-                if payment_status == "succeeded":
-                    order.status = "paid"
-                elif payment_status == "canceled":
-                    order.status = "canceled"
-                order.save()
+            if settings.YOOKASSA_WEBHOOK_MODE == 'queue':
+                # Только в очередь, статус заказа обновит задача drain_webhook_queue
+                enqueue_webhook(payment_id, event, payment_status)
                 return JsonResponse({"status": "ok"})
-            except Order.DoesNotExist:
+
+            if not apply_payment_event(payment_id, event, payment_status):
                 return JsonResponse({"error": "Заказ не найден"}, status=400)
+            return JsonResponse({"status": "ok"})
         except json.JSONDecodeError:
             return JsonResponse({"error": "Неправильный JSON формат"}, status=400)
 
     return JsonResponse({"error": "Неверный запрос"}, status=400)
 
 
+# GET /payment/webhook/yookassa/metrics - глубина и задержка очереди уведомлений
+class WebhookQueueMetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(webhook_queue_metrics())
+
 
 class LoginView(APIView):
     permission_classes = [AllowAny]
@@ -0,0 +1,211 @@
+import json
+import logging
+import threading
+import time
+
+import redis
+from redis.exceptions import LockError, WatchError
+from django.conf import settings
+from django.db import transaction
+
+from .models import Order, PaymentEvent
+
+
+# Статус заказа по статусу платежа
+ORDER_STATUS_BY_PAYMENT = {
+    'succeeded': 'paid',
+    'canceled': 'canceled',
+}
+
+# Конечные статусы платежа ЮKassa: запоздавшие уведомления не должны их перезаписывать
+FINAL_PAYMENT_STATUSES = ['succeeded', 'canceled']
+
+WEBHOOK_QUEUE_KEY = 'yookassa:webhooks'
+WEBHOOK_LOCK_KEY = 'yookassa:webhooks:lock'
+WEBHOOK_PROCESSED_KEY = 'yookassa:webhooks:processed'
+# Уведомления о платежах, заказ которых ещё не закоммичен: повторяются при следующем разборе очереди
+WEBHOOK_RETRY_KEY = 'yookassa:webhooks:retry'
+
+logger = logging.getLogger('mehashop.webhooks')
+
+
+def update_order_payment_status(payment_id, payment_status):
+    """Условный UPDATE: заказ меняется, только если статус платежа действительно новый."""
+    fields = {'payment_status': payment_status}
+    if payment_status in ORDER_STATUS_BY_PAYMENT:
+        fields['status'] = ORDER_STATUS_BY_PAYMENT[payment_status]
+    return (
+        Order.objects.filter(payment_id=payment_id)
+        .exclude(payment_status=payment_status)
+        .exclude(payment_status__in=FINAL_PAYMENT_STATUSES)
+        .update(**fields)
+    )
+
+
+def apply_payment_event(payment_id, event, payment_status):
+    """Применяет уведомление ЮKassa к заказу. False, если заказа с таким платежом нет.
+
+    Повторная доставка того же события стоит одного INSERT ... ON CONFLICT DO NOTHING,
+    заказ обновляется условным UPDATE только если статус действительно меняется.
+    """
+    with transaction.atomic():
+        if not PaymentEvent.objects.record(payment_id, event):
+            return True
+
+        updated = update_order_payment_status(payment_id, payment_status)
+        if not updated and not Order.objects.filter(payment_id=payment_id).exists():
+            # Событие не запоминаем, чтобы повторная доставка тоже получила ошибку
+            transaction.set_rollback(True)
+            return False
+    return True
+
+
+def process_webhook_batch(events):
+    """Применяет пачку уведомлений [(payment_id, event, payment_status), ...] в порядке поступления.
+
+    События группируются по платежу: уже обработанные отбрасываются по журналу,
+    из новых берётся итоговый статус (конечный статус не перезаписывается более
+    поздними), и на каждый заказ выполняется не больше одного UPDATE.
+
+    Возвращает (число новых событий, payment_id без заказа). События платежей без заказа
+    не попадают в журнал, как и в apply_payment_event: их можно применить повторно.
+    """
+    by_payment = {}
+    for payment_id, event, payment_status in events:
+        by_payment.setdefault(payment_id, []).append((event, payment_status))
+
+    with transaction.atomic():
+        known = set(Order.objects.filter(payment_id__in=by_payment.keys()).values_list('payment_id', flat=True))
+        seen = set(
+            PaymentEvent.objects.filter(payment_id__in=known).values_list('payment_id', 'event')
+        )
+        new_events = []
+        statuses = {}
+        for payment_id, payment_events in by_payment.items():
+            if payment_id not in known:
+                continue
+            for event, payment_status in payment_events:
+                if (payment_id, event) in seen:
+                    continue
+                seen.add((payment_id, event))
+                new_events.append(PaymentEvent(payment_id=payment_id, event=event))
+                if statuses.get(payment_id) not in FINAL_PAYMENT_STATUSES:
+                    statuses[payment_id] = payment_status
+
+        PaymentEvent.objects.bulk_create(new_events, ignore_conflicts=True)
+        for payment_id, payment_status in statuses.items():
+            update_order_payment_status(payment_id, payment_status)
+    return len(new_events), by_payment.keys() - known
+
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                _redis = redis.Redis.from_url(settings.REDIS_URL)
+    return _redis
+
+
+def enqueue_webhook(payment_id, event, payment_status):
+    # Время постановки в очередь нужно для метрики задержки обработки
+    get_redis().rpush(WEBHOOK_QUEUE_KEY, json.dumps([time.time(), payment_id, event, payment_status]))
+
+
+def _requeue_retries(client):
+    # Поштучный LMOVE: уведомление всегда лежит либо в очереди, либо в списке повторов
+    count = client.llen(WEBHOOK_RETRY_KEY)
+    if count:
+        pipe = client.pipeline(transaction=False)
+        for _ in range(count):
+            pipe.lmove(WEBHOOK_RETRY_KEY, WEBHOOK_QUEUE_KEY, 'LEFT', 'RIGHT')
+        pipe.execute()
+
+
+def _trim_queue(client, lock, count, retry):
+    """Удаляет из очереди обработанную пачку, если блокировка всё ещё наша.
+
+    Иначе очередь уже разбирает другой воркер: он прочитал те же записи, и удалять
+    их второй раз нельзя - пропадут записи, которых не видел ни один из воркеров.
+    """
+    with client.pipeline() as pipe:
+        try:
+            pipe.watch(WEBHOOK_LOCK_KEY)
+            if not lock.owned():
+                return False
+            pipe.multi()
+            pipe.ltrim(WEBHOOK_QUEUE_KEY, count, -1)
+            if retry:
+                pipe.rpush(WEBHOOK_RETRY_KEY, *retry)
+            pipe.incrby(WEBHOOK_PROCESSED_KEY, count - len(retry))
+            pipe.execute()
+        except WatchError:
+            return False
+    return True
+
+
+def drain_webhook_queue(batch_size=None, max_batches=100):
+    """Разбирает очередь уведомлений пачками. Возвращает число обработанных записей.
+
+    Записи удаляются из очереди только после применения пачки, поэтому при падении
+    воркера они будут обработаны повторно - это безопасно благодаря журналу событий.
+    Уведомления о платежах, заказ которых ещё не виден, повторяются при следующих
+    запусках, пока не пройдёт WEBHOOK_RETRY_SECONDS.
+    """
+    batch_size = batch_size or settings.WEBHOOK_QUEUE_BATCH_SIZE
+    client = get_redis()
+    lock = client.lock(WEBHOOK_LOCK_KEY, timeout=settings.WEBHOOK_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+    total = 0
+    try:
+        _requeue_retries(client)
+        for _ in range(max_batches):
+            # Блокировка продлевается на каждую пачку; если она истекла, разбор продолжит другой воркер
+            lock.reacquire()
+            entries = client.lrange(WEBHOOK_QUEUE_KEY, 0, batch_size - 1)
+            if not entries:
+                break
+            decoded = [json.loads(entry) for entry in entries]
+            _, unknown = process_webhook_batch([entry[1:] for entry in decoded])
+            retry = []
+            for raw, (enqueued_at, payment_id, event, payment_status) in zip(entries, decoded):
+                if payment_id not in unknown:
+                    continue
+                if time.time() - enqueued_at < settings.WEBHOOK_RETRY_SECONDS:
+                    retry.append(raw)
+                else:
+                    logger.warning("Уведомление %s для платежа %s без заказа отброшено", event, payment_id)
+            if not _trim_queue(client, lock, len(entries), retry):
+                break
+            total += len(entries) - len(retry)
+    except LockError:
+        logger.warning("Блокировка очереди уведомлений истекла, разбор остановлен")
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            pass
+    return total
+
+
+def webhook_queue_metrics():
+    client = get_redis()
+    pipe = client.pipeline()
+    pipe.llen(WEBHOOK_QUEUE_KEY)
+    pipe.lindex(WEBHOOK_QUEUE_KEY, 0)
+    pipe.get(WEBHOOK_PROCESSED_KEY)
+    pipe.llen(WEBHOOK_RETRY_KEY)
+    depth, oldest, processed, retry_depth = pipe.execute()
+    return {
+        'depth': depth,
+        # Уведомления о платежах без заказа, ждущие повтора
+        'retry_depth': retry_depth,
+        # Сколько секунд ждёт самое старое необработанное уведомление
+        'lag_seconds': round(time.time() - json.loads(oldest)[0], 3) if oldest else 0,
+        'processed_total': int(processed or 0),
+    }
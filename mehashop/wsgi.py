@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mehashop.settings')
 
 application = get_wsgi_application()
+
+from mehashop.suggest import warm_suggest_index  # noqa: E402
+
+warm_suggest_index()